@@ -4,7 +4,7 @@ setup(
     name="Terracumber",
     author="Julio González Gil",
     author_email="jgonzalez@suse.com",
-    scripts=["terracumber-cli"],
+    scripts=["terracumber-cli", "terracumber-orchestrator"],
     url="https://github.com/uyuni-project/terracumber",
     description="When Terraform meets Cucumber.",
     long_description=open("README.md").read(),
@@ -1,8 +1,62 @@
 """Manage execution and outputs of cucumber at a controler node"""
+import codecs
+import json
 import os
+import queue
 import re
+import shlex
+import shutil
 import stat
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
+from .utils import OutputTail
+
+# Size of the blocks read from the remote output, and of the buffer for the output file
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# Minimum size of a file to save the manifest before downloading it, so the download can be
+# resumed even if the process is killed. Smaller files are downloaded again from the start
+RESUME_MIN_SIZE = 1024 * 1024
+
+
+def new_ssh_client(load_system_host_keys=True, MissingHostKeyPolicy=None):
+    """Return a paramiko.client.SSHClient with the host keys policy, not connected yet
+
+    Keyword arguments:
+    load_system_host_keys - Boolean to define whetever the system host keys should be used
+                            or not
+    MissingHostKeyPolicy - AutoAddPolicy or RejectPolicy strings
+    """
+    ssh_client = paramiko.SSHClient()
+    if MissingHostKeyPolicy == "RejectPolicy":
+        MissingHostKeyPolicy = paramiko.RejectPolicy()
+    else:
+        MissingHostKeyPolicy = paramiko.AutoAddPolicy()
+    ssh_client.set_missing_host_key_policy(MissingHostKeyPolicy)
+    if load_system_host_keys:
+        ssh_client.load_system_host_keys()
+    return ssh_client
+
+
+class CountingReader:
+    """The CountingReader class wraps a file object, counting the bytes read from it
+
+    Keyword arguments:
+    fileobj - The file object to read from
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        """Read from the file object, as its read()"""
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
 
 
 class Cucumber:
@@ -14,60 +68,268 @@ class Cucumber:
                             or not
     MissingHostKeyPolicy - AutoAddPolicy or RejectPolicy strings
                            (http://docs.paramiko.org/en/2.4/api/client.html#paramiko.client.SSHClient)
+    transfer_workers - Number of files to download in parallel, each of them over its own
+                       SFTP channel on the same SSH transport
+    sync - If True, files whose local size and mtime match the remote ones are not downloaded
+           again, and interrupted downloads are resumed from their current size
+    manifest - Path to a JSON file recording the downloaded files, and the downloads in
+               progress ('complete': False). Only those are resumed when sync is True
     """
 
-    def __init__(self, conn_data, load_system_host_keys=True, MissingHostKeyPolicy=None):
+    def __init__(self, conn_data, load_system_host_keys=True, MissingHostKeyPolicy=None,
+                 transfer_workers=1, sync=False, manifest=None):
         self.conn_data = conn_data
-        self.ssh_client = paramiko.SSHClient()
-        if MissingHostKeyPolicy == "RejectPolicy":
-            MissingHostKeyPolicy = paramiko.RejectPolicy()
-        else:
-            MissingHostKeyPolicy = paramiko.AutoAddPolicy()
-        self.ssh_client.set_missing_host_key_policy(MissingHostKeyPolicy)
-        if load_system_host_keys:
-            self.ssh_client.load_system_host_keys()
+        self.configure_transfers(transfer_workers, sync, manifest)
+        self.ssh_client = new_ssh_client(load_system_host_keys, MissingHostKeyPolicy)
         self.ssh_client.connect(**conn_data)
+        # One SFTP session per thread, so several directories can be fetched at the same time
+        self.thread_data = threading.local()
+        self.sftp_clients = []
+        # Idle SFTP sessions used by the parallel downloads, kept open between calls
+        self.sftp_pool = queue.Queue()
+        self.sftp_pool_size = 0
+        # Number of remote round trips avoided by reusing the SFTP sessions and the
+        # attributes returned by listdir_attr
+        self.roundtrips_saved = 0
+        self.last_run_stats = None
+        # Last lines of the output of run_command, to report failures
+        self.output_tail = OutputTail()
+        self.lock = threading.Lock()
+        self.manifest_lock = threading.Lock()
 
-    def run_command(self, command, env_vars=None, output_file=False):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def configure_transfers(self, transfer_workers=1, sync=False, manifest=None):
+        """Set how files are downloaded. See the class documentation for the arguments.
+        Also resets sync_stats and the received bytes"""
+        self.transfer_workers = transfer_workers
+        self.sync = sync
+        self.manifest = manifest
+        self.manifest_files = {}
+        if manifest and os.path.isfile(manifest):
+            with open(manifest, 'r') as m_file:
+                self.manifest_files = json.load(m_file).get('files', {})
+        self.sync_stats = {'downloaded': 0, 'skipped': 0, 'resumed': 0}
+        # Bytes received for each downloaded file or tar stream, by absolute local path
+        self.received = {}
+
+    def share_transfers(self, other):
+        """Use the transfer configuration and state (manifest, sync_stats and received
+        bytes) of another Cucumber object, so several connections can download different
+        files for the same manifest at the same time"""
+        self.transfer_workers = other.transfer_workers
+        self.sync = other.sync
+        self.manifest = other.manifest
+        self.manifest_files = other.manifest_files
+        self.sync_stats = other.sync_stats
+        self.received = other.received
+        self.lock = other.lock
+        self.manifest_lock = other.manifest_lock
+
+    def is_active(self):
+        """Return True if the SSH connection is still open"""
+        transport = self.ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def add_roundtrips_saved(self, count=1):
+        """Increase the counter of saved round trips (safe to call from several threads)"""
+        with self.lock:
+            self.roundtrips_saved += count
+
+    def get_sftp_client(self):
+        """Return the SFTP session of the current thread for this connection, opening it
+        on first use"""
+        sftp_client = getattr(self.thread_data, 'sftp_client', None)
+        if sftp_client is None:
+            sftp_client = self.ssh_client.open_sftp()
+            self.thread_data.sftp_client = sftp_client
+            with self.lock:
+                self.sftp_clients.append(sftp_client)
+        else:
+            self.add_roundtrips_saved()
+        return sftp_client
+
+    def acquire_sftp_client(self):
+        """Take an SFTP session from the pool, opening a new one if all are busy"""
+        try:
+            sftp_client = self.sftp_pool.get_nowait()
+            self.add_roundtrips_saved()
+            return sftp_client
+        except queue.Empty:
+            sftp_client = self.ssh_client.open_sftp()
+            with self.lock:
+                self.sftp_pool_size += 1
+            return sftp_client
+
+    def release_sftp_client(self, sftp_client):
+        """Return an SFTP session to the pool"""
+        self.sftp_pool.put(sftp_client)
+
+    def run_command(self, command, env_vars=None, output_file=False, quiet=False):
         """Run a command and get print stdout and stderr (merged) to stdout and optionally a file
 
         Keyword arguments:
         command - A string with the command to execute
         env_vars - A dictionary with the environment variables to be added
         output_file - The path for a file to store stdout and stderr
+        quiet - If True, do not print the output to stdout (only to output_file)
+
+        Returns the exit status of the command. The amount of output received and the
+        throughput are stored at last_run_stats, and the last lines at output_tail
         """
         tran = self.ssh_client.get_transport()
         chan = tran.open_session()
         # Merge stdout and stderr in order
         chan.get_pty()
         chan.update_environment(env_vars)
-        chan_stream = chan.makefile()
         tran.set_keepalive(10)
         chan.exec_command(command)
+        # Read the output in blocks, as reading it line by line is too CPU expensive for
+        # big outputs. The decoder keeps multibyte characters split between blocks
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        o_file = None
         if output_file:
-            o_file = open(output_file, 'a')
-        for line in chan_stream:
-            print(line.strip())
-            if output_file:
-                o_file.write(line)
-        if output_file:
-            o_file.close()
+            o_file = open(output_file, 'a', buffering=OUTPUT_BUFFER_SIZE)
+        received = 0
+        start = time.monotonic()
+        try:
+            while True:
+                data = chan.recv(OUTPUT_BUFFER_SIZE)
+                received += len(data)
+                # At the end, flush an incomplete multibyte character as a replacement
+                text = decoder.decode(data, final=not data)
+                if text:
+                    self.output_tail.feed(text)
+                    if o_file:
+                        o_file.write(text)
+                    if not quiet:
+                        sys.stdout.write(text.replace('\r\n', '\n'))
+                        sys.stdout.flush()
+                if not data:
+                    break
+        finally:
+            if o_file:
+                o_file.close()
+        elapsed = time.monotonic() - start
+        self.last_run_stats = {'bytes': received, 'seconds': elapsed,
+                               'bytes_per_second': received / elapsed if elapsed else 0}
         return chan.recv_exit_status()
 
-    def copy_atime_mtime(self, remote_path, local_path):
+    def exec_command(self, command):
+        """Run a command without a PTY and return a tuple with its exit status and its
+        stdout. Only intended for commands with a small output
+
+        Keyword arguments:
+        command - A string with the command to execute
+        """
+        chan = self.ssh_client.get_transport().open_session()
+        chan.exec_command(command)
+        output = chan.makefile('rb').read()
+        return chan.recv_exit_status(), output
+
+    def get_tar(self, remotedir, localdir, compress=False):
+        """Get a directory (recursively) from the controller as a tar stream
+
+        The stream produced by tar at the controller is extracted as it arrives, keeping
+        modes and mtimes. Useful for directories with many small files, where the per file
+        overhead of SFTP is bigger than the data itself. The extracted files are recorded
+        as complete at the manifest, so a later sync skips them.
+
+        Keyword arguments:
+        remotedir - A string with the path for the remote dir to be copied
+        localdir - A string with the path for the local dir, including
+                   the directory to be copied
+        compress - If True, compress the stream with gzip
+        """
+        chan = self.ssh_client.get_transport().open_session()
+        chan.exec_command('tar -C %s -c%sf - .' % (shlex.quote(remotedir), 'z' if compress else ''))
+        if not os.path.isdir(localdir):
+            os.mkdir(localdir)
+        extract_args = {}
+        # Python >= 3.12 (and backports): reject absolute paths and links outside localdir
+        if hasattr(tarfile, 'tar_filter'):
+            extract_args['filter'] = 'tar'
+        extracted = []
+
+        def iter_members(tar):
+            for member in tar:
+                if member.isreg():
+                    extracted.append(member)
+                yield member
+
+        stream = CountingReader(chan.makefile('rb'))
+        try:
+            with tarfile.open(fileobj=stream, mode='r|gz' if compress else 'r|') as tar:
+                tar.extractall(localdir, members=iter_members(tar), **extract_args)
+        finally:
+            self.count_received(localdir, stream.count)
+        status = chan.recv_exit_status()
+        if status != 0:
+            raise IOError("tar for %s exited with status %s" % (remotedir, status))
+        with self.lock:
+            for member in extracted:
+                name = os.path.normpath(member.name)
+                self.manifest_files[self.manifest_key(os.path.join(localdir, name))] = {
+                    'remote': remotedir.rstrip('/') + '/' + name, 'size': member.size,
+                    'mtime': int(member.mtime), 'complete': True}
+        self.save_manifest()
+
+    def get_directory(self, remotedir, localdir, tar_threshold=-1, compress=False):
+        """Get a directory (recursively) from the controller, picking the transfer strategy
+
+        A tar stream is used if the remote directory has at least tar_threshold files
+        and tar is available at the controller. Otherwise, or if the tar transfer fails,
+        the directory is copied with get_recursive(). When sync is enabled and the local
+        directory already exists, get_recursive() is always used, so only the delta is
+        transferred.
+
+        Keyword arguments:
+        remotedir - A string with the path for the remote dir to be copied
+        localdir - A string with the path for the local dir, including
+                   the directory to be copied
+        tar_threshold - Minimum number of files to use a tar stream, -1 to never use it
+        compress - If True, compress the tar stream with gzip
+
+        Returns the strategy used: 'tar' or 'sftp'
+        """
+        if tar_threshold < 0 or (self.sync and os.path.isdir(localdir)):
+            self.get_recursive(remotedir, localdir)
+            return 'sftp'
+        status, output = self.exec_command(
+            'cd %s 2>/dev/null || exit 2; command -v tar >/dev/null 2>&1 || exit 3; '
+            'find . -type f | wc -l' % shlex.quote(remotedir))
+        if status == 2:
+            raise FileNotFoundError(remotedir)
+        if status == 0 and int(output.strip() or 0) >= tar_threshold:
+            try:
+                self.get_tar(remotedir, localdir, compress)
+                return 'tar'
+            except (IOError, tarfile.TarError):
+                pass
+        self.get_recursive(remotedir, localdir)
+        return 'sftp'
+
+    def copy_atime_mtime(self, remote_path, local_path, attributes=None):
         """Copy atime and mtime from a remote path to a local path
 
         Keyword arguments:
         remote_path: A string with the remote path
         local_path: A string with the local path
+        attributes: The SFTPAttributes for remote_path, if already known (for example
+                    from listdir_attr). If not present, the remote path will be stat'ed
         """
         # This is required because paramiko does not provide any parameter
         # to preserve modification times, access times, and modes as -p
         # on scp
-        sftp_client = self.ssh_client.open_sftp()
-        atime = sftp_client.stat(remote_path).st_atime
-        mtime = sftp_client.stat(remote_path).st_mtime
-        os.utime(local_path, (atime, mtime))
+        if attributes is None:
+            attributes = self.get_sftp_client().stat(remote_path)
+        else:
+            self.add_roundtrips_saved()
+        os.utime(local_path, (attributes.st_atime, attributes.st_mtime))
 
     def get(self, remotepath, localpath):
         """Get a file from the controller
@@ -77,17 +339,17 @@ class Cucumber:
         localpath - A string with the local path to the folder where data is to be copied
         """
         copied_files = []
-        sftp_client = self.ssh_client.open_sftp()
+        sftp_client = self.get_sftp_client()
         path = remotepath.rsplit('/', 1)[0]
         filename = remotepath.rsplit('/', 1)[1]
         files = sftp_client.listdir(path)
         for fname in files:
             if re.match("^%s$" % filename, fname):
                 copied_files.append(path + '/' + fname)
-                sftp_client.get(path + '/' + fname, localpath + '/' + fname)
-                self.copy_atime_mtime(path + '/' + fname, localpath + '/' + fname)
+                self.fetch_file(sftp_client, path + '/' + fname, localpath + '/' + fname)
         if not copied_files:
             raise FileNotFoundError
+        self.save_manifest()
         return(copied_files)
 
     def get_by_extensions(self, remotedir, localdir, extensions):
@@ -101,23 +363,140 @@ class Cucumber:
         Returns a list of remote paths that were downloaded.
         Subdirectories and files with other extensions are silently skipped.
         """
-        downloaded = []
-        sftp_client = self.ssh_client.open_sftp()
+        files = []
+        sftp_client = self.get_sftp_client()
+        for entry in sftp_client.listdir_attr(remotedir):
+            if not stat.S_ISREG(entry.st_mode):
+                continue
+            _, ext = os.path.splitext(entry.filename)
+            if ext not in extensions:
+                continue
+            remote_path = remotedir.rstrip('/') + '/' + entry.filename
+            local_path = localdir.rstrip('/') + '/' + entry.filename
+            files.append((remote_path, local_path, entry))
+        self.download_files(files)
+        return [remote_path for remote_path, _, _ in files]
+
+    def download_files(self, files):
+        """Download a list of files, in parallel if transfer_workers is greater than 1
+
+        Keyword arguments:
+        files - A list of (remote path, local path, SFTPAttributes) tuples
+        """
         try:
-            for entry in sftp_client.listdir_attr(remotedir):
-                if not stat.S_ISREG(entry.st_mode):
-                    continue
-                _, ext = os.path.splitext(entry.filename)
-                if ext not in extensions:
-                    continue
-                remote_path = remotedir.rstrip('/') + '/' + entry.filename
-                local_path = localdir.rstrip('/') + '/' + entry.filename
-                sftp_client.get(remote_path, local_path)
-                self.copy_atime_mtime(remote_path, local_path)
-                downloaded.append(remote_path)
-            return downloaded
+            if self.transfer_workers <= 1 or len(files) <= 1:
+                sftp_client = self.get_sftp_client()
+                for remote_path, local_path, attributes in files:
+                    self.fetch_file(sftp_client, remote_path, local_path, attributes)
+                return
+            with ThreadPoolExecutor(max_workers=min(self.transfer_workers, len(files))) as executor:
+                # Consume the results, so the exceptions from the workers are raised here
+                list(executor.map(lambda args: self.fetch_file_from_pool(*args), files))
         finally:
-            sftp_client.close()
+            # Also on errors, so an interrupted transfer can be resumed
+            self.save_manifest()
+
+    def fetch_file(self, sftp_client, remote_path, local_path, attributes=None):
+        """Download a single file and copy its atime and mtime
+
+        When sync is enabled, the file is skipped if the local copy is already complete,
+        and resumed if the manifest records an interrupted download of the same remote
+        file. Any other local file that does not match the remote one is downloaded again.
+        """
+        if not self.sync:
+            self.sftp_get(sftp_client, remote_path, local_path)
+            self.copy_atime_mtime(remote_path, local_path, attributes)
+            self.count_sync_stat('downloaded')
+            return
+        if attributes is None:
+            attributes = sftp_client.stat(remote_path)
+        try:
+            local_stat = os.stat(local_path)
+        except FileNotFoundError:
+            local_stat = None
+        key = self.manifest_key(local_path)
+        entry = {'remote': remote_path, 'size': attributes.st_size, 'mtime': int(attributes.st_mtime)}
+        with self.lock:
+            previous = self.manifest_files.get(key)
+        if local_stat is not None and local_stat.st_size == attributes.st_size and \
+                int(local_stat.st_mtime) == int(attributes.st_mtime):
+            self.count_sync_stat('skipped')
+        elif local_stat is not None and local_stat.st_size < attributes.st_size and \
+                previous == dict(entry, complete=False):
+            # The same remote file was being downloaded when the transfer was interrupted
+            with sftp_client.open(remote_path, 'rb') as r_file, open(local_path, 'ab') as l_file:
+                r_file.seek(local_stat.st_size)
+                r_file.prefetch(attributes.st_size)
+                shutil.copyfileobj(r_file, l_file)
+            self.count_received(local_path, attributes.st_size - local_stat.st_size)
+            self.copy_atime_mtime(remote_path, local_path, attributes)
+            self.count_sync_stat('resumed')
+        else:
+            with self.lock:
+                self.manifest_files[key] = dict(entry, complete=False)
+            if attributes.st_size >= RESUME_MIN_SIZE:
+                self.save_manifest()
+            self.sftp_get(sftp_client, remote_path, local_path)
+            self.copy_atime_mtime(remote_path, local_path, attributes)
+            self.count_sync_stat('downloaded')
+        with self.lock:
+            self.manifest_files[key] = dict(entry, complete=True)
+
+    def sftp_get(self, sftp_client, remote_path, local_path):
+        """Download a file with an SFTP session, counting the bytes received"""
+        transferred = [0]
+
+        def progress(done, total):
+            transferred[0] = done
+
+        try:
+            sftp_client.get(remote_path, local_path, callback=progress)
+        finally:
+            self.count_received(local_path, transferred[0])
+
+    def count_sync_stat(self, name):
+        """Increase one of the sync_stats counters (safe to call from several threads)"""
+        with self.lock:
+            self.sync_stats[name] += 1
+
+    def count_received(self, local_path, size):
+        """Add the bytes received for a local file or directory (safe to call from several threads)"""
+        key = os.path.abspath(local_path)
+        with self.lock:
+            self.received[key] = self.received.get(key, 0) + size
+
+    def get_received_bytes(self, paths):
+        """Return the bytes received since configure_transfers() for a list of local files
+        and directories (including everything inside them), not counting skipped files"""
+        prefixes = [os.path.abspath(local_path) for local_path in paths]
+        with self.lock:
+            received = list(self.received.items())
+        return sum(size for local_path, size in received
+                   if any(local_path == prefix or local_path.startswith(prefix + os.sep) for prefix in prefixes))
+
+    def manifest_key(self, local_path):
+        """Return the key used at the manifest for a local path"""
+        if self.manifest:
+            return os.path.relpath(local_path, os.path.dirname(os.path.abspath(self.manifest)))
+        return os.path.abspath(local_path)
+
+    def save_manifest(self):
+        """Write the list of downloaded files to the manifest, if any"""
+        if not self.manifest or not self.sync:
+            return
+        with self.manifest_lock:
+            with self.lock:
+                data = {'files': dict(self.manifest_files)}
+            with open(self.manifest, 'w') as m_file:
+                json.dump(data, m_file, indent=2, sort_keys=True)
+
+    def fetch_file_from_pool(self, remote_path, local_path, attributes):
+        """Download a single file using an SFTP session from the pool"""
+        sftp_client = self.acquire_sftp_client()
+        try:
+            self.fetch_file(sftp_client, remote_path, local_path, attributes)
+        finally:
+            self.release_sftp_client(sftp_client)
 
     def put_file(self, localpath, remotepath):
         """Put a file in the controller
@@ -126,7 +505,7 @@ class Cucumber:
         localpath - A string with the local path to a file to be copied to the controler
         remotepath - A string with the full remote path
         """
-        sftp_client = self.ssh_client.open_sftp()
+        sftp_client = self.get_sftp_client()
         sftp_client.put(localpath, remotepath)
 
     # Credit goes to https://stackoverflow.com/a/50130813
@@ -137,8 +516,21 @@ class Cucumber:
         remotedir - A string with the path for the remote dir to be copied
         localdir - A string with the path for the local dir, including
                    the directory to be copied
+        sftp_client - Unused, kept for backwards compatibility. The SFTP session
+                      of the connection is always reused
+
+        The remote tree is listed first, and then the files are downloaded with
+        download_files()
+        """
+        files = []
+        self.list_recursive(remotedir, localdir, files)
+        self.download_files(files)
+
+    def list_recursive(self, remotedir, localdir, files):
+        """Create the local directory tree for a remote directory, and append the
+        files to be downloaded to `files` as expected by download_files()
         """
-        sftp_client = self.ssh_client.open_sftp()
+        sftp_client = self.get_sftp_client()
         if not os.path.isdir(localdir):
             os.mkdir(localdir)
         for entry in sftp_client.listdir_attr(remotedir):
@@ -148,14 +540,138 @@ class Cucumber:
             if stat.S_ISDIR(mode):
                 try:
                     os.mkdir(localpath)
-                    self.copy_atime_mtime(remotepath, localpath)
+                    self.copy_atime_mtime(remotepath, localpath, entry)
                 except OSError:
                     pass
-                self.get_recursive(remotepath, localpath, sftp_client)
+                self.list_recursive(remotepath, localpath, files)
             elif stat.S_ISREG(mode):
-                sftp_client.get(remotepath, localpath)
-                self.copy_atime_mtime(remotepath, localpath)
+                files.append((remotepath, localpath, entry))
+
+    def close(self):
+        """Close the SFTP session and the SSH connection to the controller"""
+        for sftp_client in self.sftp_clients:
+            sftp_client.close()
+        self.sftp_clients = []
+        self.thread_data = threading.local()
+        while not self.sftp_pool.empty():
+            self.sftp_pool.get_nowait().close()
+        self.sftp_pool_size = 0
+        self.ssh_client.close()
+
+
+class BastionTunnel:
+    """The BastionTunnel class keeps one SSH transport open to a bastion, and opens as many
+    forwarded (direct-tcpip) channels through it as needed, to any host behind the bastion
+
+    Keyword arguments:
+    conn_data - dictionary for paramiko.client.SSHClient, for the bastion
+    load_system_host_keys - Boolean to define whetever the system host keys should be used
+                            or not
+    MissingHostKeyPolicy - AutoAddPolicy or RejectPolicy strings
+    """
+
+    def __init__(self, conn_data, load_system_host_keys=True, MissingHostKeyPolicy=None):
+        self.conn_data = conn_data
+        self.ssh_client = new_ssh_client(load_system_host_keys, MissingHostKeyPolicy)
+        self.ssh_client.connect(**conn_data)
+        self.ssh_client.get_transport().set_keepalive(10)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_channel(self, hostname, port=22):
+        """Open a new channel forwarded to a host behind the bastion, to be used as sock
+        for paramiko.client.SSHClient
+
+        Keyword arguments:
+        hostname - A string with the host to connect to from the bastion
+        port - The SSH port of that host
+        """
+        return self.ssh_client.get_transport().open_channel(
+            "direct-tcpip", (hostname, port), (self.conn_data['hostname'], self.conn_data.get('port', 22)))
 
     def close(self):
-        """Close the SSH connection to the controller"""
+        """Close the SSH connection to the bastion, and with it all the forwarded channels"""
         self.ssh_client.close()
+
+
+class ConnectionManager:
+    """The ConnectionManager class shares Cucumber connections, so all the steps working with
+    the same host reuse one authenticated SSH transport
+
+    Keyword arguments:
+    load_system_host_keys - Boolean to define whetever the system host keys should be used
+                            or not, for all connections
+    MissingHostKeyPolicy - AutoAddPolicy or RejectPolicy strings, for all connections
+    tunnel - A BastionTunnel. If present, every connection without a sock uses its own
+             channel forwarded through the bastion
+    """
+
+    def __init__(self, load_system_host_keys=True, MissingHostKeyPolicy=None, tunnel=None):
+        self.load_system_host_keys = load_system_host_keys
+        self.MissingHostKeyPolicy = MissingHostKeyPolicy
+        self.tunnel = tunnel
+        self.connections = {}
+        self.extra_connections = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, conn_data, **kwargs):
+        """Return a Cucumber object for conn_data, reusing the connection to the same
+        host, port and user if it is still open
+
+        Keyword arguments:
+        conn_data - dictionary for paramiko.client.SSHClient
+        kwargs - Arguments for Cucumber.configure_transfers(). If not present, the
+                 current transfer configuration of a reused connection is kept
+        """
+        key = (conn_data['hostname'], conn_data.get('port', 22), conn_data.get('username'))
+        with self.lock:
+            cucumber = self.connections.get(key)
+            if cucumber is not None and cucumber.is_active():
+                if kwargs:
+                    cucumber.configure_transfers(**kwargs)
+                return cucumber
+            cucumber = self.connect(conn_data, **kwargs)
+            self.connections[key] = cucumber
+            return cucumber
+
+    def open(self, conn_data, **kwargs):
+        """Return a new Cucumber object for conn_data, not shared with any other caller.
+        Through a bastion, it gets its own forwarded channel, so it is not serialized with
+        the traffic of the other connections
+
+        Keyword arguments:
+        conn_data - dictionary for paramiko.client.SSHClient
+        kwargs - Arguments for Cucumber.configure_transfers()
+        """
+        cucumber = self.connect(conn_data, **kwargs)
+        with self.lock:
+            self.extra_connections.append(cucumber)
+        return cucumber
+
+    def connect(self, conn_data, **kwargs):
+        """Create a Cucumber object, through the bastion if there is a tunnel"""
+        if self.tunnel is not None and conn_data.get('sock') is None:
+            conn_data = dict(conn_data,
+                             sock=self.tunnel.open_channel(conn_data['hostname'], conn_data.get('port', 22)))
+        return Cucumber(conn_data, self.load_system_host_keys, self.MissingHostKeyPolicy, **kwargs)
+
+    def close(self):
+        """Close all the connections, and the bastion tunnel if there is one"""
+        with self.lock:
+            for cucumber in list(self.connections.values()) + self.extra_connections:
+                cucumber.close()
+            self.connections = {}
+            self.extra_connections = []
+            if self.tunnel is not None:
+                self.tunnel.close()
+                self.tunnel = None
@@ -0,0 +1,189 @@
+"""Extract data from cucumber JSON reports"""
+import json
+import mmap
+import re
+from glob import escape, glob
+from heapq import nlargest
+from os import path
+from .junit import Junit, add_to_summary, new_summary
+
+# Characters read at once from the reports. When a feature does not fit, the size is
+# doubled, so big features are decoded only a few times
+READ_SIZE = 1024 * 1024
+WHITESPACE = re.compile(r'\s*')
+# Type of the elements of a feature that are counted as tests
+SCENARIO_TYPE = re.compile(rb'"type"\s*:\s*"scenario"')
+
+
+def iter_features(tfile, read_size=READ_SIZE):
+    """Iterate over the features at a cucumber JSON report, decoding them one by one
+
+    Only one feature is kept in memory at a time, so the memory used depends on the size
+    of the biggest feature and not on the size of the report.
+    """
+    decoder = json.JSONDecoder()
+    with open(tfile, 'r', encoding='utf-8') as report:
+        buffer = ''
+        # Position of the first character at the buffer not decoded yet
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                char = buffer[pos]
+                if not started:
+                    if char != '[':
+                        raise ValueError('%s is not a cucumber JSON report' % tfile)
+                    started = True
+                    pos += 1
+                    continue
+                if char == ',':
+                    pos += 1
+                    continue
+                if char == ']':
+                    return
+                try:
+                    feature, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The feature is not complete at the buffer
+                    if eof:
+                        raise
+                else:
+                    yield feature
+                    continue
+            elif eof:
+                if started:
+                    raise ValueError('%s is truncated' % tfile)
+                return
+            buffer = buffer[pos:]
+            pos = 0
+            chunk = report.read(max(read_size, len(buffer)))
+            eof = not chunk
+            buffer += chunk
+
+
+def count_scenarios(tfile):
+    """Return the number of scenarios at a cucumber JSON report, found without decoding
+    it, so it is much cheaper than parsing the report. For a truncated report, only the
+    scenarios before the end are counted"""
+    with open(tfile, 'rb') as report:
+        if path.getsize(tfile) == 0:
+            return 0
+        with mmap.mmap(report.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return sum(1 for _ in SCENARIO_TYPE.finditer(data))
+
+
+def get_scenario_status(statuses):
+    """Return the status of a scenario as for junit (see terracumber.junit.TESTCASE_STATUSES)
+    from the statuses of its steps and hooks"""
+    if 'failed' in statuses or 'ambiguous' in statuses:
+        return 'failed'
+    if 'skipped' in statuses or 'undefined' in statuses or 'pending' in statuses:
+        return 'skipped'
+    return 'passed'
+
+
+def iterparse_file(tfile):
+    """Parse a cucumber JSON report in a single streaming pass, as an iterator
+
+    Yields the same items as terracumber.junit.iterparse_file(), with a testcase for
+    each scenario (including the steps of the background before it), failed if a step or
+    hook failed and skipped if a step was skipped, undefined or pending, as the junit
+    formatter of cucumber does. Durations are added up from the steps and hooks.
+    """
+    totals = {'failures': 0, 'errors': 0, 'skipped': 0, 'tests': 0, 'time': 0}
+    for feature in iter_features(tfile):
+        classname = feature.get('name', '')
+        background = []
+        for element in feature.get('elements', []):
+            results = [item.get('result', {}) for key in ('before', 'steps', 'after')
+                       for item in element.get(key, [])]
+            if element.get('type') == 'background':
+                background = results
+                continue
+            results = background + results
+            status = get_scenario_status([result.get('status') for result in results])
+            # Durations are in nanoseconds
+            time = sum(result.get('duration', 0) for result in results) / 1000000000
+            name = element.get('name', '')
+            if status == 'failed':
+                totals['failures'] += 1
+                yield ('failure', 'failed %s' % name, '{}::{}'.format(classname, name))
+            elif status == 'skipped':
+                totals['skipped'] += 1
+            totals['tests'] += 1
+            totals['time'] += time
+            yield ('testcase', classname, name, time, status)
+    yield ('totals', totals)
+
+
+def parse_file(tfile):
+    """Parse a whole cucumber JSON report with iterparse_file()
+
+    Returns a dictionary as terracumber.junit.parse_file()
+    """
+    summary = new_summary()
+    for item in iterparse_file(tfile):
+        add_to_summary(summary, item)
+    return summary
+
+
+def iter_step_durations(tfile):
+    """Iterate over the steps at a cucumber JSON report, as (classname::name, step, seconds)
+    for each step of each scenario, with step as the keyword and the name of the step"""
+    for feature in iter_features(tfile):
+        for element in feature.get('elements', []):
+            for step in element.get('steps', []):
+                yield ('{}::{}'.format(feature.get('name', ''), element.get('name', '')),
+                       '{}{}'.format(step.get('keyword', ''), step.get('name', '')),
+                       step.get('result', {}).get('duration', 0) / 1000000000)
+
+
+class CucumberJson(Junit):
+    """The CucumberJson class extracts the same data as the Junit class from cucumber
+    JSON reports, for when the junit output XML files are missing or incomplete
+
+    Keyword arguments:
+    path - A string with the directory containing the cucumber JSON reports
+    pattern - A glob pattern for the reports at the directory
+    Other arguments as for Junit
+    """
+
+    def __init__(self, path, pattern='output*.json', **kwargs):
+        super().__init__(path, **kwargs)
+        self.pattern = pattern
+
+    def get_parsers(self):
+        """Return the functions used to parse a report: (iterparse_file, parse_file)"""
+        return iterparse_file, parse_file
+
+    def sort_test_files_by_mtime(self):
+        """Return an array with the cucumber JSON reports ordered by mtime"""
+        return sorted(glob(path.join(escape(self.path), self.pattern)), key=path.getmtime)
+
+    def count_scenarios(self):
+        """Return the number of scenarios at the reports, None if there are no reports.
+        Only the reports not parsed yet are scanned (see count_scenarios()), with reruns
+        counted again even if merge_reruns is True"""
+        tfiles = self.sort_test_files_by_mtime()
+        if not tfiles:
+            return None
+        count = 0
+        for tfile in tfiles:
+            summary = self.lookup(self.get_key(tfile))
+            count += summary['totals']['tests'] if summary is not None else count_scenarios(tfile)
+        return count
+
+    def get_step_durations(self, number=-1):
+        """Return a list with (classname::name, step, seconds) for the steps at the
+        reports, slowest first
+
+        Keyword arguments:
+        number: The maximum number of steps to return, -1 for all steps
+        """
+        steps = (step for tfile in self.sort_test_files_by_mtime()
+                 for step in iter_step_durations(tfile))
+        if number == -1:
+            return sorted(steps, key=lambda step: step[2], reverse=True)
+        return nlargest(number, steps, key=lambda step: step[2])
@@ -0,0 +1,149 @@
+"""Detect when the inputs of terraform did not change since its last successful apply or init"""
+import json
+import re
+from hashlib import sha256
+from os import environ, makedirs, path, readlink, stat, unlink, walk
+
+# File at the terraform path with the fingerprint of the last successful apply
+FINGERPRINT_FILE = '.terracumber-fingerprint.json'
+# File with the fingerprint of the last successful init, inside the directory created by init
+INIT_FILE = '.terraform/terracumber-init.json'
+# Lines at the .tf files that need terraform init when they change: module and provider
+# sources and versions, and backends
+INIT_LINES = re.compile(r'^\s*((source|version)\s*=\s*"[^"]*"|backend\s+"[^"]*")', re.MULTILINE)
+# Environment variables changing what terraform does
+ENVIRONMENT_PREFIXES = ('TF_VAR_', 'TF_CLI_ARGS')
+
+
+def get_git_head(folder):
+    """Return the commit checked out at a git repository, None if it is not one"""
+    git_dir = path.join(folder, '.git')
+    try:
+        with open(path.join(git_dir, 'HEAD'), 'r') as head:
+            ref = head.read().strip()
+        if not ref.startswith('ref: '):
+            return ref
+        ref = ref[len('ref: '):]
+        if path.isfile(path.join(git_dir, ref)):
+            with open(path.join(git_dir, ref), 'r') as ref_file:
+                return ref_file.read().strip()
+        with open(path.join(git_dir, 'packed-refs'), 'r') as packed_refs:
+            for line in packed_refs:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split(' ')[0]
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return None
+
+
+def get_inputs_fingerprint(terraform_path, files, variables, terraform_bin):
+    """Return a hash of the inputs for terraform apply, besides the state
+
+    Keyword arguments:
+    terraform_path - A string with the path where the terraform code is
+    files - A list with the files at terraform_path used by terraform (main.tf, tfvars...)
+    variables - A dictionary with the variables for the environment of terraform
+    terraform_bin - The path to the terraform binary
+    """
+    digest = sha256()
+    for name in files:
+        digest.update(name.encode('utf-8') + b'\0')
+        filename = path.join(terraform_path, name)
+        if path.isfile(filename):
+            with open(filename, 'rb') as tfile:
+                digest.update(tfile.read())
+        digest.update(b'\0')
+    backend = path.join(terraform_path, 'modules', 'backend')
+    inputs = {'git_head': get_git_head(terraform_path),
+              'backend': readlink(backend) if path.islink(backend) else None,
+              'terraform_bin': terraform_bin,
+              'variables': variables,
+              'environment': {key: value for key, value in environ.items()
+                              if key.startswith(ENVIRONMENT_PREFIXES)}}
+    digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_init_fingerprint(terraform_path, terraform_bin, plugin_cache_dir=None):
+    """Return a hash of the inputs for terraform init: the lock file, the sources and versions
+    of the modules and providers and the backends at the .tf files, and the backend symlink
+
+    Keyword arguments:
+    terraform_path - A string with the path where the terraform code is
+    terraform_bin - The path to the terraform binary
+    plugin_cache_dir - The directory for TF_PLUGIN_CACHE_DIR, None if there is none
+    """
+    digest = sha256()
+    lock_file = path.join(terraform_path, '.terraform.lock.hcl')
+    if path.isfile(lock_file):
+        with open(lock_file, 'rb') as tfile:
+            digest.update(tfile.read())
+    for folder, folders, files in walk(terraform_path):
+        # Sorted, so the hash does not depend on the order of the directory entries
+        folders[:] = sorted(name for name in folders if not name.startswith('.'))
+        for name in sorted(files):
+            if not name.endswith('.tf'):
+                continue
+            with open(path.join(folder, name), 'r', encoding='utf-8', errors='replace') as tfile:
+                lines = [match.group(1) for match in INIT_LINES.finditer(tfile.read())]
+            if lines:
+                digest.update(path.relpath(path.join(folder, name), terraform_path).encode('utf-8') + b'\0')
+                digest.update('\n'.join(lines).encode('utf-8') + b'\0')
+    backend = path.join(terraform_path, 'modules', 'backend')
+    inputs = {'backend': readlink(backend) if path.islink(backend) else None,
+              'terraform_bin': terraform_bin,
+              'plugin_cache_dir': plugin_cache_dir}
+    digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def needs_init(terraform_path, inputs):
+    """Return True if terraform init was never run successfully for the terraform path
+    or its inputs changed since then, according to the fingerprint saved by save_init()"""
+    try:
+        with open(path.join(terraform_path, INIT_FILE), 'r') as init_file:
+            return json.load(init_file).get('inputs') != inputs
+    except (OSError, ValueError):
+        return True
+
+
+def save_init(terraform_path, inputs):
+    """Save the fingerprint of the inputs after a successful init"""
+    makedirs(path.dirname(path.join(terraform_path, INIT_FILE)), exist_ok=True)
+    with open(path.join(terraform_path, INIT_FILE), 'w') as init_file:
+        json.dump({'inputs': inputs}, init_file)
+
+
+def get_state_fingerprint(terraform_path):
+    """Return [inode, mtime, size] for the tfstate file, None if there is none"""
+    try:
+        tf_state_stat = stat(path.join(terraform_path, 'terraform.tfstate'))
+    except FileNotFoundError:
+        return None
+    return [tf_state_stat.st_ino, tf_state_stat.st_mtime_ns, tf_state_stat.st_size]
+
+
+def is_unchanged(terraform_path, inputs):
+    """Return True if the inputs and the state are the same as after the last successful
+    apply, that saved its fingerprint with save_fingerprint()"""
+    try:
+        with open(path.join(terraform_path, FINGERPRINT_FILE), 'r') as fingerprint_file:
+            fingerprint = json.load(fingerprint_file)
+    except (OSError, ValueError):
+        return False
+    return (fingerprint.get('inputs') == inputs and
+            fingerprint.get('state') == get_state_fingerprint(terraform_path))
+
+
+def save_fingerprint(terraform_path, inputs):
+    """Save the fingerprint of the inputs and the state after a successful apply"""
+    with open(path.join(terraform_path, FINGERPRINT_FILE), 'w') as fingerprint_file:
+        json.dump({'inputs': inputs, 'state': get_state_fingerprint(terraform_path)}, fingerprint_file)
+
+
+def forget_fingerprint(terraform_path):
+    """Remove the saved fingerprint, so the next apply is never skipped"""
+    try:
+        unlink(path.join(terraform_path, FINGERPRINT_FILE))
+    except FileNotFoundError:
+        pass
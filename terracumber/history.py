@@ -0,0 +1,250 @@
+"""Keep an index with the junit results of all the builds at an output directory"""
+import sqlite3
+from os import listdir, path
+from xml.etree.ElementTree import ParseError
+from .junit import Junit
+
+# Errors raised for a build whose junit output XML files are malformed or unreadable
+INGEST_ERRORS = (OSError, ParseError, KeyError, ValueError)
+
+# Weight of the last duration for the baseline of a test (exponential moving average),
+# so the baseline follows slow changes but one slow build does not hide the next one
+BASELINE_WEIGHT = 0.2
+
+
+def update_baseline(baseline, samples, time):
+    """Return the baseline after adding the duration of a passed run to it
+
+    Keyword arguments:
+    baseline - The current baseline, None if there are no samples
+    samples - The number of durations already added to the baseline
+    time - The duration of the passed run
+    """
+    if not samples:
+        return time
+    return baseline + BASELINE_WEIGHT * (time - baseline)
+
+
+def build_sort_key(build):
+    """Sort builds numerically when they are BUILD_NUMBER, and alphabetically when
+    they are BUILD_TIMESTAMP (%Y-%m-%d-%H-%M-%S, so the order is chronological)"""
+    if build.isdigit():
+        return (0, int(build), build)
+    return (1, 0, build)
+
+
+class History:
+    """The History class ingests the junit output XML files for each build at an output
+    directory (<outputdir>/<build>/results_junit) to an SQLite database, and answers
+    queries about the results of the tests across builds
+
+    Builds are ordered by the order they are ingested, that is the order of the build
+    numbers or timestamps for each ingestion (see build_sort_key())
+
+    Each result also stores the baseline duration of the test up to the previous build
+    that ran it (see update_baseline()), computed only from that previous result when the
+    build is ingested, so detecting slower tests does not need to read older builds. The
+    database is emptied if it was created by an incompatible version, so the builds are
+    ingested again.
+
+    Keyword arguments:
+    db_path - A string with the path for the SQLite database
+    logger - A logger for the builds that cannot be ingested, None to skip them silently
+    """
+
+    # Increase when the tables change
+    VERSION = 1
+
+    def __init__(self, db_path, logger=None):
+        self.db_path = db_path
+        self.logger = logger
+        self.connection = sqlite3.connect(db_path)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.connection.executescript('''
+                DROP TABLE IF EXISTS results;
+                DROP TABLE IF EXISTS tests;
+                DROP TABLE IF EXISTS builds;
+                PRAGMA user_version = %d;
+            ''' % self.VERSION)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS builds (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS tests (id INTEGER PRIMARY KEY, classname TEXT, name TEXT,
+                                              UNIQUE (classname, name));
+            CREATE TABLE IF NOT EXISTS results (test_id INTEGER, build_id INTEGER, status TEXT,
+                                                time REAL, baseline REAL, samples INTEGER,
+                                                PRIMARY KEY (test_id, build_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS results_build_time ON results (build_id, time);
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_builds(self):
+        """Return a list with the names of the ingested builds, oldest first"""
+        return [row[0] for row in self.connection.execute('SELECT name FROM builds ORDER BY id')]
+
+    def get_build_id(self, build=None):
+        """Return the id for a build, or for the last ingested build if build is None.
+        None if the build was not ingested"""
+        if build is None:
+            row = self.connection.execute('SELECT MAX(id) FROM builds').fetchone()
+        else:
+            row = self.connection.execute('SELECT id FROM builds WHERE name = ?', (build,)).fetchone()
+        return row[0] if row else None
+
+    def get_test_id(self, classname, name):
+        """Return the id for a test, adding it if it is new"""
+        row = self.connection.execute('SELECT id FROM tests WHERE classname = ? AND name = ?',
+                                      (classname, name)).fetchone()
+        if row:
+            return row[0]
+        return self.connection.execute('INSERT INTO tests (classname, name) VALUES (?, ?)',
+                                       (classname, name)).lastrowid
+
+    def ingest_build(self, build, junit_path, cache=None):
+        """Store the results for a build from its junit output XML files, replacing the
+        ones already stored for it. Returns the number of testcases stored
+
+        When a testcase is at several files (i.e. it was rerun), the result from the most
+        recent file is kept.
+
+        Keyword arguments:
+        build - The name of the build
+        junit_path - A string with the directory with the junit output XML files
+        cache - A string with the path to the junit cache of the build (see terracumber.junit.Junit)
+        """
+        testcases = {}
+        with Junit(junit_path, cache=cache) as junit:
+            for classname, name, time, status in junit.get_testcases():
+                testcases[(classname, name)] = (status, time)
+        with self.connection:
+            build_id = self.get_build_id(build)
+            if build_id is None:
+                build_id = self.connection.execute('INSERT INTO builds (name) VALUES (?)',
+                                                   (build,)).lastrowid
+            results = []
+            for (classname, name), (status, time) in testcases.items():
+                test_id = self.get_test_id(classname, name)
+                results.append((test_id, build_id, status, time) + self.get_baseline(test_id, build_id))
+            self.connection.execute('DELETE FROM results WHERE build_id = ?', (build_id,))
+            self.connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)', results)
+        return len(results)
+
+    def get_baseline(self, test_id, build_id):
+        """Return (baseline, samples) for a test with the passed results before a build"""
+        row = self.connection.execute(
+            'SELECT status, time, baseline, samples FROM results WHERE test_id = ? AND build_id < ? '
+            'ORDER BY build_id DESC LIMIT 1', (test_id, build_id)).fetchone()
+        if row is None:
+            return (None, 0)
+        status, time, baseline, samples = row
+        if status != 'passed':
+            return (baseline, samples)
+        return (update_baseline(baseline, samples, time), samples + 1)
+
+    def ingest(self, outputdir, refresh=(), only_new=False):
+        """Ingest the builds at an output directory that were not ingested yet
+
+        A build whose junit output XML files cannot be read is skipped (and logged), so it
+        does not stop the ingestion of the others, and it is tried again the next time.
+
+        Keyword arguments:
+        outputdir - A string with the directory containing one directory per build
+        refresh - Names of builds to ingest again even if they were already ingested
+                  (i.e. the current build, if its results can still change)
+        only_new - Only ingest the builds after the last ingested build (and the ones at
+                   refresh), so the older builds are not read. Nothing is ingested if the
+                   database is empty, as adding the older builds later would break the order
+
+        Returns a list with the names of the ingested builds
+        """
+        known = set(self.get_builds())
+        if only_new and not known:
+            return []
+        newest = max(known, key=build_sort_key) if known else None
+        ingested = []
+        for build in sorted(listdir(outputdir), key=build_sort_key):
+            junit_path = path.join(outputdir, build, 'results_junit')
+            if (build in known and build not in refresh) or not path.isdir(junit_path):
+                continue
+            if only_new and build not in refresh and build_sort_key(build) < build_sort_key(newest):
+                continue
+            try:
+                self.ingest_build(build, junit_path, path.join(outputdir, build, 'junit_cache.sqlite'))
+            except INGEST_ERRORS as error:
+                if self.logger is not None:
+                    self.logger.warning("WARNING: cannot ingest the junit results of build %s: %s: %s",
+                                        build, type(error).__name__, error)
+                continue
+            ingested.append(build)
+        return ingested
+
+    def last_results(self, classname, name, number=10):
+        """Return a list with (build, status, time) for the last results of a test, most
+        recent first
+
+        Keyword arguments:
+        classname - The classname of the test (the feature for cucumber)
+        name - The name of the test (the scenario for cucumber)
+        number - The maximum number of results to return
+        """
+        return self.connection.execute(
+            'SELECT builds.name, results.status, results.time FROM results '
+            'JOIN tests ON tests.id = results.test_id JOIN builds ON builds.id = results.build_id '
+            'WHERE tests.classname = ? AND tests.name = ? ORDER BY results.build_id DESC LIMIT ?',
+            (classname, name, number)).fetchall()
+
+    def flipped_tests(self, build=None):
+        """Return a list with (classname, name, previous status, status) for the tests whose
+        status at a build is not the same as at the previous build that ran them
+
+        Keyword arguments:
+        build - The name of the build, None for the last ingested build
+        """
+        return self.connection.execute(
+            'SELECT tests.classname, tests.name, previous.status, current.status '
+            'FROM results AS current JOIN tests ON tests.id = current.test_id '
+            'JOIN results AS previous ON previous.test_id = current.test_id AND '
+            'previous.build_id = (SELECT MAX(build_id) FROM results WHERE '
+            'test_id = current.test_id AND build_id < current.build_id) '
+            'WHERE current.build_id = ? AND previous.status != current.status '
+            'ORDER BY tests.classname, tests.name', (self.get_build_id(build),)).fetchall()
+
+    def slowest_tests(self, build=None, number=10):
+        """Return a list with (classname, name, time) for the slowest tests at a build,
+        slowest first
+
+        Keyword arguments:
+        build - The name of the build, None for the last ingested build
+        number - The maximum number of tests to return
+        """
+        return self.connection.execute(
+            'SELECT tests.classname, tests.name, results.time FROM results '
+            'JOIN tests ON tests.id = results.test_id WHERE results.build_id = ? '
+            'ORDER BY results.time DESC LIMIT ?', (self.get_build_id(build), number)).fetchall()
+
+    def slow_tests(self, build=None, factor=1.5, min_seconds=10, min_samples=3, number=10):
+        """Return a list with (classname, name, time, baseline) for the passed tests at a build
+        that were slower than their baseline, biggest regression (in seconds) first
+
+        Keyword arguments:
+        build - The name of the build, None for the last ingested build
+        factor - Minimum ratio between the time and the baseline
+        min_seconds - Minimum difference between the time and the baseline, so short tests
+                      do not appear because of small variations
+        min_samples - Minimum number of previous passed results for the baseline
+        number - The maximum number of tests to return
+        """
+        return self.connection.execute(
+            'SELECT tests.classname, tests.name, results.time, results.baseline FROM results '
+            'JOIN tests ON tests.id = results.test_id WHERE results.build_id = ? AND '
+            "results.status = 'passed' AND results.samples >= ? AND results.time >= results.baseline * ? "
+            'AND results.time - results.baseline >= ? ORDER BY results.time - results.baseline DESC '
+            'LIMIT ?', (self.get_build_id(build), min_samples, factor, min_seconds, number)).fetchall()
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
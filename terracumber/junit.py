@@ -1,14 +1,194 @@
 """Extract data from junit output XML files"""
-from os import path
+import json
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from os import cpu_count, path, stat
 from pathlib import Path
-from xml.dom import minidom
+from xml.etree.ElementTree import iterparse
+
+# Minimum number of files to be parsed to use a process pool. Below that, starting the
+# processes costs more than what they save (see test/benchmark_junit.py)
+PARALLEL_THRESHOLD = 64
+# Start method for the processes parsing the files. Forking a process with threads running
+# (i.e. the ones of the SSH connections still open) can deadlock the children
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Status of a testcase according to its children, 'passed' if it has none of them
+TESTCASE_CHILD_STATUSES = {'failure': 'failed', 'error': 'error', 'skipped': 'skipped'}
+TESTCASE_STATUSES = ['passed', 'failed', 'error', 'skipped']
+
+
+def iterparse_file(tfile):
+    """Parse a junit output XML file in a single streaming pass, as an iterator
+
+    Elements are discarded as soon as they are processed, so the memory used does not
+    depend on the size of the file. The file is read only as far as the iterator is
+    consumed.
+
+    Yields ('failure', message, classname::name) for each failure as soon as it is found,
+    ('testcase', classname, name, time, status) once each testcase is closed, with status
+    as one of TESTCASE_STATUSES, and ('totals', totals) once the whole file was read, with
+    totals as a dictionary with the elements failures, errors, skipped, tests, time, added
+    up from all the testsuites at the file.
+    """
+    totals = {'failures': 0, 'errors': 0, 'skipped': 0, 'tests': 0, 'time': 0}
+    # Elements still open, so every element can be removed from its parent once processed
+    parents = []
+    status = 'passed'
+    for event, elem in iterparse(tfile, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'testsuite':
+                totals['failures'] += int(elem.attrib['failures'])
+                totals['errors'] += int(elem.attrib['errors'])
+                totals['skipped'] += int(elem.attrib['skipped'])
+                totals['tests'] += int(elem.attrib['tests'])
+                totals['time'] += float(elem.attrib['time'])
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'failure':
+            testcase = parents[-1]
+            yield ('failure', elem.attrib['message'],
+                   "{}::{}".format(testcase.attrib.get('classname', ''), testcase.attrib['name']))
+        if elem.tag in TESTCASE_CHILD_STATUSES and parents and parents[-1].tag == 'testcase':
+            status = TESTCASE_CHILD_STATUSES[elem.tag]
+        elif elem.tag == 'testcase':
+            yield ('testcase', elem.attrib.get('classname', ''), elem.attrib['name'],
+                   float(elem.attrib.get('time', 0)), status)
+            status = 'passed'
+        if parents:
+            parents[-1].remove(elem)
+        elem.clear()
+    yield ('totals', totals)
+
+
+def new_summary():
+    """Return an empty summary, to be filled with add_to_summary()"""
+    return {'totals': None, 'failures': [], 'failures_saltshaker': [], 'testcases': []}
+
+
+def add_to_summary(summary, item):
+    """Add an item from iterparse_file() to a summary"""
+    if item[0] == 'failure':
+        summary['failures'].append(item[1])
+        summary['failures_saltshaker'].append(item[2])
+    elif item[0] == 'testcase':
+        summary['testcases'].append(list(item[1:]))
+    else:
+        summary['totals'] = item[1]
+
+
+def parse_file(tfile):
+    """Parse a whole junit output XML file with iterparse_file()
+
+    Returns a dictionary with the elements:
+    totals - A dictionary with the elements failures, errors, skipped, tests, time, added up
+             from all the testsuites at the file
+    failures - A list with the message of each failure
+    failures_saltshaker - A list with classname::name for the testcase of each failure
+    testcases - A list with [classname, name, time, status] for each testcase
+    """
+    summary = new_summary()
+    for item in iterparse_file(tfile):
+        add_to_summary(summary, item)
+    return summary
+
+
+class JunitCache:
+    """The JunitCache class stores the results of parse_file() in an SQLite database, so
+    files that did not change are not parsed again by later runs
+
+    Keyword arguments:
+    db_path - A string with the path for the SQLite database. Files are stored relative
+              to its directory, so the results can be moved together with the database
+    """
+
+    # Increase when the summaries change, so the ones stored by older versions are discarded
+    VERSION = 1
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.connection.execute('DROP TABLE IF EXISTS summaries')
+            self.connection.execute('PRAGMA user_version = %d' % self.VERSION)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS summaries (path TEXT PRIMARY KEY, '
+                                'size INTEGER, mtime_ns INTEGER, summary TEXT)')
+
+    def get_key(self, tfile):
+        """Return the key for a file at the database"""
+        return path.relpath(path.abspath(tfile), path.dirname(path.abspath(self.db_path)))
+
+    def get(self, tfile, size, mtime_ns):
+        """Return the stored summary for a file, or None if it is not stored or the file
+        was changed or replaced since then"""
+        row = self.connection.execute('SELECT summary FROM summaries WHERE path = ? AND size = ? '
+                                      'AND mtime_ns = ?', (self.get_key(tfile), size, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, tfile, size, mtime_ns, summary):
+        """Store the summary for a file, replacing any older one. Use commit() to save it"""
+        self.connection.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)',
+                                (self.get_key(tfile), size, mtime_ns, json.dumps(summary)))
+
+    def commit(self):
+        """Save the stored summaries to the database"""
+        self.connection.commit()
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
 
 
 class Junit:
-    """The junit class extracts data from junit output XML files"""
+    """The junit class extracts data from junit output XML files
+
+    Each file is parsed only once per instance (unless it changes), no matter how many
+    totals and failures are requested.
 
-    def __init__(self, path):
+    Keyword arguments:
+    path - A string with the directory containing the junit output XML files
+    cache - A string with the path for an SQLite database to keep the parsed files between
+            runs (see JunitCache). It is only created if there are files to parse
+    processes - Number of processes to parse files in parallel, None for the number of CPUs
+                and 1 to always parse them serially
+    parallel_threshold - Minimum number of files to be parsed to use several processes
+    merge_reruns - If True, a testcase at several files (i.e. cucumber was run again) is
+                   counted once, with its result from the most recent file (see get_merged())
+    """
+
+    def __init__(self, path, cache=None, processes=None, parallel_threshold=PARALLEL_THRESHOLD,
+                 merge_reruns=False):
         self.path = path
+        self.merge_reruns = merge_reruns
+        self.cache_path = cache
+        self.cache = None
+        self.processes = processes or cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        # Parsed files, by (path, size, mtime)
+        self.parsed = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the cache, if it is open. It is opened again if it is needed later"""
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def get_cache(self):
+        """Return the JunitCache, opening it on first use. None if there is no cache"""
+        if self.cache is None and self.cache_path:
+            self.cache = JunitCache(self.cache_path)
+        return self.cache
 
     def sort_test_files_by_mtime(self):
         """Return an array with the junit output XML files ordered by mtime"""
@@ -20,44 +200,186 @@ class Junit:
             return []
         return sorted(file_list, key=path.getmtime, reverse=False)
 
+    def get_parsers(self):
+        """Return the functions used to parse a file: (iterparse_file, parse_file). Both
+        must return the same items and summaries as the ones for junit, and parse_file
+        must be a module level function, so it can be used by a pool of processes"""
+        return iterparse_file, parse_file
+
+    def get_key(self, tfile):
+        """Return the key identifying the current version of a file: (path, size, mtime)"""
+        tfile_stat = stat(tfile)
+        return (tfile, tfile_stat.st_size, tfile_stat.st_mtime_ns)
+
+    def lookup(self, key):
+        """Return the summary for a key if it was already parsed by this object or is at
+        the cache, None otherwise"""
+        if key not in self.parsed:
+            cache = self.get_cache()
+            summary = cache.get(*key) if cache else None
+            if summary is None:
+                return None
+            self.parsed[key] = summary
+        return self.parsed[key]
+
+    def store(self, key, summary):
+        """Keep the summary for a key, also at the cache if there is one"""
+        self.parsed[key] = summary
+        if self.cache:
+            self.cache.put(*key, summary)
+
+    def get_summary(self, tfile):
+        """Return the result of parse_file() for a file, parsing it only if it is new or changed"""
+        key = self.get_key(tfile)
+        summary = self.lookup(key)
+        if summary is None:
+            summary = self.get_parsers()[1](tfile)
+            self.store(key, summary)
+        return summary
+
+    def get_summaries(self):
+        """Return a list with the result of parse_file() for each file, ordered by mtime
+
+        Files not parsed yet are parsed by a pool of processes if there are at least
+        parallel_threshold of them.
+        """
+        keys = [self.get_key(tfile) for tfile in self.sort_test_files_by_mtime()]
+        missing = [key for key in keys if self.lookup(key) is None]
+        parse = self.get_parsers()[1]
+        if self.processes > 1 and len(missing) >= max(self.parallel_threshold, 2):
+            processes = min(self.processes, len(missing))
+            with ProcessPoolExecutor(max_workers=processes,
+                                     mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+                summaries = executor.map(parse, [key[0] for key in missing],
+                                         chunksize=max(1, len(missing) // (processes * 4)))
+                for key, summary in zip(missing, summaries):
+                    self.store(key, summary)
+        else:
+            for key in missing:
+                self.store(key, parse(key[0]))
+        if self.cache:
+            self.cache.commit()
+        return [self.parsed[key] for key in keys]
+
+    def get_merged(self):
+        """Merge the testcases from all the files, keeping only the result from the most
+        recent file for each (classname, name)
+
+        Returns None if there are no files, or a dictionary with the elements:
+        totals - As returned by get_totals(), counting the final result for each testcase
+        failures - A list with the message of each failure at the final results
+        failures_saltshaker - A list with classname::name for each failure at the final results
+        recovered - A list with classname::name for each testcase that failed or had an error
+                    at some file, but passed at the most recent one
+        """
+        summaries = self.get_summaries()
+        if not summaries:
+            return None
+        # classname::name: [status, time, failure message, failed at an older file]
+        latest = {}
+        for summary in summaries:
+            messages = dict(zip(summary['failures_saltshaker'], summary['failures']))
+            for classname, name, time, status in summary['testcases']:
+                identity = "{}::{}".format(classname, name)
+                failed_before = False
+                if identity in latest:
+                    previous = latest[identity]
+                    failed_before = previous[3] or previous[0] in ['failed', 'error']
+                latest[identity] = [status, time, messages.get(identity), failed_before]
+        merged = {'totals': {'failures': 0, 'errors': 0, 'skipped': 0, 'passed': 0, 'tests': 0, 'time': 0},
+                  'failures': [], 'failures_saltshaker': [], 'recovered': []}
+        status_totals = {'passed': 'passed', 'failed': 'failures', 'error': 'errors', 'skipped': 'skipped'}
+        for identity, (status, time, message, failed_before) in latest.items():
+            merged['totals'][status_totals[status]] += 1
+            merged['totals']['tests'] += 1
+            merged['totals']['time'] += time
+            if status == 'failed':
+                merged['failures'].append(message)
+                merged['failures_saltshaker'].append(identity)
+            elif status == 'passed' and failed_before:
+                merged['recovered'].append(identity)
+        return merged
+
+    def get_recovered(self):
+        """Return a list with classname::name for the testcases that passed after failing
+        at an older file (see get_merged())"""
+        merged = self.get_merged()
+        return merged['recovered'] if merged else []
+
     def get_totals(self):
         """Get the totals for all tests at the parsed junit output XML files
 
         Returns a dictionary with the elements: failures, errors, skipped, tests, time.
         All integers except time, that is a real.
         """
+        if self.merge_reruns:
+            merged = self.get_merged()
+            return merged['totals'] if merged else None
         found = False
         res = {'failures': 0, 'errors': 0, 'skipped': 0, 'passed': 0, 'tests': 0, 'time': 0}
-        for tfile in self.sort_test_files_by_mtime():
+        for summary in self.get_summaries():
             found = True
-            testsuites = minidom.parse(tfile).getElementsByTagName('testsuite')
-            for testsuite in testsuites:
-                res['failures'] += int(testsuite.attributes['failures'].value)
-                res['errors'] += int(testsuite.attributes['errors'].value)
-                res['skipped'] += int(testsuite.attributes['skipped'].value)
-                res['tests'] += int(testsuite.attributes['tests'].value)
-                res['time'] += float(testsuite.attributes['time'].value)
+            for key, value in summary['totals'].items():
+                res[key] += value
         res['passed'] = res['tests'] - res['failures'] - \
             res['errors'] - res['skipped']
         if found:
             return res
         return None
 
+    def get_testcases(self):
+        """Return a list with (classname, name, time, status) for each testcase at the
+        junit output XML files, ordered by the mtime of the files"""
+        return [tuple(testcase) for summary in self.get_summaries()
+                for testcase in summary['testcases']]
+
+    def iter_failures(self, saltshaker=False):
+        """Iterate over the failure messages for failed tests, reading the files only as far
+        as needed. Files read completely are kept as any other parsed file. With merge_reruns,
+        all the files are read first, as a later file can have the final result of a test
+
+        Keyword arguments:
+        saltshaker: If True, return the failures as Salt Shaker does (classname::name)
+        """
+        field = 'failures_saltshaker' if saltshaker else 'failures'
+        if self.merge_reruns:
+            merged = self.get_merged()
+            if merged:
+                yield from merged[field]
+            return
+        try:
+            for tfile in self.sort_test_files_by_mtime():
+                key = self.get_key(tfile)
+                summary = self.lookup(key)
+                if summary is not None:
+                    yield from summary[field]
+                    continue
+                summary = new_summary()
+                for item in self.get_parsers()[0](tfile):
+                    add_to_summary(summary, item)
+                    if item[0] == 'failure':
+                        yield summary[field][-1]
+                self.store(key, summary)
+        finally:
+            if self.cache:
+                self.cache.commit()
+
+    def has_failures(self):
+        """Return True if there is at least one failure, stopping at the first one"""
+        for _ in self.iter_failures():
+            return True
+        return False
+
     def get_failures(self, number=-1):
         """Return a list of failure messages for failed tests.
 
         Keyword arguments:
         number: The maximum number of messages to return, -1 for all messages
         """
-        failures = []
-        for tfile in self.sort_test_files_by_mtime():
-            j_failures = minidom.parse(tfile).getElementsByTagName('failure')
-            for j_failure in j_failures:
-                if len(failures) < number or number == -1:
-                    failures.append(j_failure.attributes['message'].value)
-                else:
-                    break
-        return failures
+        if number == -1:
+            return list(self.iter_failures())
+        # As before, no messages for other negative numbers
+        return list(islice(self.iter_failures(), max(number, 0)))
 
     def get_failures_saltshaker(self, number=-1):
         """Return a list of failure messages for failed tests from Salt Shaker.
@@ -65,16 +387,7 @@ class Junit:
         Keyword arguments:
         number: The maximum number of messages to return, -1 for all messages
         """
-        failures = []
-        for tfile in self.sort_test_files_by_mtime():
-            j_failures = minidom.parse(tfile).getElementsByTagName('failure')
-            for j_failure in j_failures:
-                if len(failures) < number or number == -1:
-                    failures.append("{}::{}".format(
-                        j_failure.parentNode.attributes['classname'].value,
-                        j_failure.parentNode.attributes['name'].value,
-                        )
-                    )
-                else:
-                    break
-        return failures
+        if number == -1:
+            return list(self.iter_failures(saltshaker=True))
+        # As before, no messages for other negative numbers
+        return list(islice(self.iter_failures(saltshaker=True), max(number, 0)))
@@ -0,0 +1,156 @@
+"""Provision several terraform environments at the same time"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, path
+from time import monotonic
+from .terraformer import Terraformer
+
+# Keys needed by each environment definition
+REQUIRED_KEYS = ('name', 'maintf', 'terraform_path')
+# Values for the keys that are optional at each environment definition
+DEFAULTS = {'backend': 'libvirt',
+            'tfvars_files': [],
+            'variables_description_file': '',
+            'variables': {},
+            'parallelism': 10,
+            'init': False,
+            'taint': None,
+            'taint_replace': False,
+            'destroy': False,
+            'unchanged_inputs': 'apply',
+            'timeline': False}
+
+
+def load_environments(filename):
+    """Return a list of dictionaries with the environment definitions at a JSON file,
+    with the defaults for the keys that are missing
+
+    The file has a list of objects with the keys at REQUIRED_KEYS (the name of the
+    environment, the path to its main.tf and the directory where terraform runs for it)
+    and optionally the ones at DEFAULTS. ValueError is raised if a definition is not valid
+    or two environments use the same name or terraform path, as they would overwrite the
+    logs or the state of each other.
+    """
+    with open(filename, 'r') as environments_file:
+        definitions = json.load(environments_file)
+    if not isinstance(definitions, list):
+        raise ValueError('%s does not have a list of environments' % filename)
+    environments = []
+    names = set()
+    terraform_paths = set()
+    for definition in definitions:
+        if not isinstance(definition, dict):
+            raise ValueError('%s has an environment that is not an object' % filename)
+        missing = [key for key in REQUIRED_KEYS if not definition.get(key)]
+        if missing:
+            raise ValueError('%s has an environment without %s' % (filename, ', '.join(missing)))
+        unknown = sorted(set(definition) - set(REQUIRED_KEYS) - set(DEFAULTS))
+        if unknown:
+            raise ValueError('Environment %s has unknown keys: %s' % (definition['name'], ', '.join(unknown)))
+        if definition['name'] in names:
+            raise ValueError('Environment %s is defined more than once' % definition['name'])
+        terraform_path = path.abspath(definition['terraform_path'])
+        if terraform_path in terraform_paths:
+            raise ValueError('Environment %s uses the terraform path of another environment' % definition['name'])
+        names.add(definition['name'])
+        terraform_paths.add(terraform_path)
+        environment = dict(DEFAULTS)
+        environment.update(definition)
+        environments.append(environment)
+    return environments
+
+
+class Orchestrator:
+    """The Orchestrator class runs terraform init and apply for several environments, with
+    a bounded number of them running at the same time
+
+    Each environment writes the output of terraform to its own log file instead of the
+    console. A failure (or an exception) only stops its environment, and the result for
+    each environment is returned at the end of run().
+
+    Keyword arguments:
+    environments - A list of dictionaries with the environment definitions (see load_environments())
+    logdir - A string with the directory for the logs, one <name>.log file per environment
+    max_parallel - The maximum number of environments running at the same time
+    terraform_bin - Path to the terraform binary
+    plugin_cache_dir - String with a directory for the providers shared by all the environments
+                       (None to avoid it)
+    """
+
+    def __init__(self, environments, logdir, max_parallel=2, terraform_bin='/usr/bin/terraform',
+                 plugin_cache_dir=None):
+        self.environments = environments
+        self.logdir = logdir
+        self.max_parallel = max_parallel
+        self.terraform_bin = terraform_bin
+        self.plugin_cache_dir = plugin_cache_dir
+
+    def get_logfile(self, environment):
+        """Return the path to the log file for an environment"""
+        return path.join(self.logdir, '%s.log' % environment['name'])
+
+    def get_terraformer(self, environment):
+        """Return a quiet Terraformer for an environment, logging to its own file"""
+        return Terraformer(environment['terraform_path'], environment['maintf'], environment['backend'],
+                           environment['variables'], self.get_logfile(environment), self.terraform_bin,
+                           environment['variables_description_file'], environment['tfvars_files'],
+                           plugin_cache_dir=self.plugin_cache_dir, quiet=True, timeline=environment['timeline'])
+
+    def run_environment(self, environment):
+        """Run terraform for an environment, never raising an exception
+
+        Returns a dictionary with the name, the status ('passed', 'failed' when terraform
+        failed and 'error' when an exception was raised), the step running when it
+        stopped, a message, the duration in seconds and the log file.
+        """
+        result = {'name': environment['name'], 'status': 'passed', 'step': None, 'message': '',
+                  'time': 0, 'logfile': self.get_logfile(environment)}
+        start = monotonic()
+        try:
+            terraform = self.get_terraformer(environment)
+            result['step'] = 'init'
+            if terraform.init(force=environment['init']) != 0:
+                result['status'] = 'failed'
+            else:
+                if environment['taint']:
+                    result['step'] = 'taint'
+                    terraform.taint(environment['taint'], replace=environment['taint_replace'])
+                if environment['destroy']:
+                    result['step'] = 'destroy'
+                    terraform.destroy()
+                result['step'] = 'apply'
+                if terraform.apply(environment['parallelism'],
+                                   unchanged_inputs=environment['unchanged_inputs']) != 0:
+                    result['status'] = 'failed'
+            if result['status'] == 'failed':
+                lines = [line for line in terraform.output_tail.get_lines() if line.strip()]
+                result['message'] = lines[-1] if lines else ''
+            else:
+                result['step'] = None
+        except Exception as error:  # pylint: disable=broad-except
+            result['status'] = 'error'
+            result['message'] = '%s: %s' % (type(error).__name__, error)
+        result['time'] = monotonic() - start
+        return result
+
+    def run(self):
+        """Run terraform for all the environments, returning a list with the result for
+        each environment (see run_environment()), in the order of the definitions"""
+        makedirs(self.logdir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel)) as executor:
+            return list(executor.map(self.run_environment, self.environments))
+
+
+def format_summary(results):
+    """Return a string with one line per environment result (see Orchestrator.run())"""
+    lines = []
+    for result in results:
+        line = '%s: %s in %.0fs' % (result['name'], result['status'].upper(), result['time'])
+        if result['status'] != 'passed':
+            line += ' at %s' % result['step']
+            if result['message']:
+                line += ' (%s)' % result['message']
+        lines.append(line + ', log at %s' % result['logfile'])
+    passed = len([result for result in results if result['status'] == 'passed'])
+    lines.append('%d of %d environments passed' % (passed, len(results)))
+    return '\n'.join(lines)
@@ -0,0 +1,167 @@
+"""Choose the parallelism for terraform apply from the durations of previous applies"""
+import json
+from math import ceil, log2
+from os import cpu_count, getloadavg, makedirs, path, replace
+from time import time
+from .utils import FileLock
+
+# File with the previous applies, shared by all the jobs at the host
+PARALLELISM_HISTORY = path.expanduser('~/.cache/terracumber/parallelism.json')
+# Values tried for the parallelism, from the lowest to the highest
+CANDIDATES = (1, 2, 4, 6, 8, 10, 15, 20, 30)
+# Parallelism to start with and maximum parallelism for each backend. With libvirt the
+# resources are created at the same host, so a high value makes the disks the bottleneck,
+# while with cloud providers the time is mostly spent waiting for their APIs
+BACKENDS = {'libvirt': {'default': 6, 'max': 10},
+            'aws': {'default': 10, 'max': 30},
+            'null': {'default': 10, 'max': 10}}
+DEFAULT_BACKEND = {'default': 10, 'max': 30}
+# Applies kept for each backend and number of resources
+MAX_RECORDS = 20
+
+
+def get_resources_bucket(resources):
+    """Return the bucket for a number of resources (0 or the next power of two), so
+    environments of a similar size share their history"""
+    if resources <= 0:
+        return 0
+    return 2 ** ceil(log2(resources))
+
+
+class ParallelismAdvisor:
+    """The ParallelismAdvisor class chooses the parallelism for terraform apply from the
+    applies recorded for the same backend and a similar number of resources, and the
+    load of the host, and records the outcome of each apply
+
+    The parallelism with the shortest mean duration of the successful applies is used,
+    after trying each of its neighbours at CANDIDATES once, so the value moves towards
+    the fastest one for the environment. The parallelism is lowered when the host is
+    overloaded (load average above the number of CPUs).
+
+    Only full applies should be recorded (creating the whole environment), as the
+    duration of an apply changing a few resources says little about the parallelism.
+    The number of resources after each successful apply is remembered for its terraform
+    path, so an environment with an empty state (new or destroyed) is still matched with
+    the applies for its real size.
+
+    Keyword arguments:
+    backend - The sumaform backend (libvirt, aws, null...)
+    resources - The number of resources at the terraform state, 0 if it is empty
+    history_file - A string with the path to the JSON file with the previous applies
+    terraform_path - A string with the path where terraform runs, None if unknown
+    """
+
+    def __init__(self, backend, resources, history_file=PARALLELISM_HISTORY, terraform_path=None):
+        self.backend = backend
+        self.history_file = history_file
+        self.terraform_path = path.abspath(terraform_path) if terraform_path else None
+        self.resources = resources or self.get_last_resources()
+        limits = BACKENDS.get(backend, DEFAULT_BACKEND)
+        self.default = limits['default']
+        self.candidates = [candidate for candidate in CANDIDATES if candidate <= limits['max']]
+
+    def get_key(self):
+        """Return the key for the applies of the backend and number of resources"""
+        return '%s:%d' % (self.backend, get_resources_bucket(self.resources))
+
+    def load_history(self):
+        """Return the dictionary with the previous applies by key ('applies') and the number
+        of resources after the last successful apply by terraform path ('resources')"""
+        try:
+            with open(self.history_file, 'r') as history_file:
+                history = json.load(history_file)
+        except (OSError, ValueError):
+            history = None
+        if not isinstance(history, dict) or not isinstance(history.get('applies'), dict) or \
+                not isinstance(history.get('resources'), dict):
+            return {'applies': {}, 'resources': {}}
+        return history
+
+    def get_records(self):
+        """Return a list with the previous applies for the backend and number of resources,
+        oldest first"""
+        return self.load_history()['applies'].get(self.get_key(), [])
+
+    def get_last_resources(self):
+        """Return the number of resources after the last successful apply recorded for the
+        terraform path, 0 if there is none"""
+        if self.terraform_path is None:
+            return 0
+        return self.load_history()['resources'].get(self.terraform_path, 0)
+
+    def choose(self, load=None, cpus=None):
+        """Return (parallelism, reason) for the next apply
+
+        Keyword arguments:
+        load - The load average of the host, None to read it
+        cpus - The number of CPUs of the host, None to read it
+        """
+        durations = {}
+        last_result = {}
+        for record in self.get_records():
+            last_result[record['parallelism']] = record['result']
+            if record['result'] == 0:
+                durations.setdefault(record['parallelism'], []).append(record['seconds'])
+        means = {parallelism: sum(seconds) / len(seconds) for parallelism, seconds in durations.items()
+                 if parallelism in self.candidates}
+        if not means:
+            choice = self.default
+            reason = 'no successful applies recorded, using the default for %s' % self.backend
+            # Go down from the default while the last apply with the value failed
+            lower = [candidate for candidate in self.candidates
+                     if candidate <= choice and last_result.get(candidate, 0) == 0]
+            if lower and lower[-1] != choice:
+                choice = lower[-1]
+                reason = 'the last applies failed, lowering the default for %s' % self.backend
+        else:
+            choice = min(means, key=lambda parallelism: (means[parallelism], parallelism))
+            reason = 'fastest mean duration (%.0fs) of the recorded applies' % means[choice]
+            index = self.candidates.index(choice)
+            neighbours = self.candidates[index + 1:index + 2] + self.candidates[max(0, index - 1):index]
+            for neighbour in neighbours:
+                if neighbour not in last_result:
+                    reason = 'trying a neighbour of %d, the fastest recorded (%.0fs)' % (choice, means[choice])
+                    choice = neighbour
+                    break
+        load = getloadavg()[0] if load is None else load
+        cpus = (cpu_count() or 1) if cpus is None else cpus
+        if load > cpus:
+            index = self.candidates.index(choice) if choice in self.candidates else len(self.candidates) - 1
+            steps = min(int(load / cpus), index)
+            if steps:
+                choice = self.candidates[index - steps]
+                reason += ', lowered as the host is overloaded (load %.1f for %d CPUs)' % (load, cpus)
+        return choice, reason
+
+    def record(self, parallelism, seconds, result, resources=None, load=None, cpus=None):
+        """Add a full apply to the history, keeping the last MAX_RECORDS applies for the
+        backend and number of resources
+
+        Keyword arguments:
+        parallelism - The parallelism used
+        seconds - The duration of the apply
+        result - The exit code of terraform apply
+        resources - The number of resources at the state after the apply. Used for the
+                    applies that succeeded, so they are recorded with the real size of the
+                    environment, and remembered for the terraform path
+        load - The load average of the host, None to read it
+        cpus - The number of CPUs of the host, None to read it
+        """
+        if result == 0 and resources:
+            self.resources = resources
+        makedirs(path.dirname(path.abspath(self.history_file)), exist_ok=True)
+        # Other jobs at the same host can record their applies at the same time
+        with FileLock(self.history_file + '.lock'):
+            history = self.load_history()
+            if result == 0 and resources and self.terraform_path:
+                history['resources'][self.terraform_path] = resources
+            records = history['applies'].setdefault(self.get_key(), [])
+            records.append({'parallelism': parallelism, 'seconds': seconds, 'result': result,
+                            'resources': self.resources,
+                            'load': getloadavg()[0] if load is None else load,
+                            'cpus': (cpu_count() or 1) if cpus is None else cpus,
+                            'time': time()})
+            del records[:-MAX_RECORDS]
+            with open(self.history_file + '.tmp', 'w') as history_file:
+                json.dump(history, history_file, indent=2)
+            replace(self.history_file + '.tmp', self.history_file)
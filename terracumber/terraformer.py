@@ -1,16 +1,26 @@
 """Run and manage terraform"""
-from json import load
-from os import environ, path, symlink, unlink
-from re import match
+import re
+from os import environ, makedirs, path, symlink, unlink
 from shutil import copy
 from subprocess import CalledProcessError, Popen, PIPE, STDOUT
+from time import monotonic
+from .fingerprint import forget_fingerprint, get_init_fingerprint, get_inputs_fingerprint, is_unchanged, \
+    needs_init, save_fingerprint, save_init
+from .parallelism import PARALLELISM_HISTORY, ParallelismAdvisor
+from .tfstate import get_tfstate, list_addresses
+from .timeline import Timeline
 from .tfvars_cleaner import remove_unselected_tfvars_resources
 
 # Fallback to allow running python3 -m unittest
 try:
-    from utils import merge_two_dicts
+    from utils import merge_two_dicts, FileLock, OutputTail
 except ImportError:
-    from .utils import merge_two_dicts
+    from .utils import merge_two_dicts, FileLock, OutputTail
+
+# Plan saved at the terraform path to be applied when the inputs did not change
+PLAN_FILE = 'terracumber.tfplan'
+# Address of a data source, at the root module or at any module
+DATA_SOURCE_ADDRESS = r'^(module\.[^.\[]+(\[[^\]]*\])?\.)*data\.'
 
 
 class Terraformer:
@@ -24,9 +34,19 @@ class Terraformer:
     output_file - String with the path to a file to store console output to the specified file
                   (False to avoid it)
     terraform_bin - path to terraform bin
+    plugin_cache_dir - String with a directory for the providers (TF_PLUGIN_CACHE_DIR), shared by
+                       all the terraform paths (None to avoid it)
+    quiet - If True, do not print anything to the console, but only to the output file, so
+            several environments can run at the same time
+    timeline - If True, run terraform apply with -json, writing the human readable messages
+               to the console and the output file, and the start, end and duration of each
+               resource to a JSON file next to the output file (see get_timeline_file())
+    parallelism_history - String with the path to the JSON file with the previous applies, used
+                          by apply() with parallelism='auto'
     """
 
-    def __init__(self, terraform_path, maintf, backend, variables={}, output_file=False, terraform_bin='/usr/bin/terraform', variables_description_file="", tfvars_files=[]):
+    def __init__(self, terraform_path, maintf, backend, variables={}, output_file=False, terraform_bin='/usr/bin/terraform', variables_description_file="", tfvars_files=[],
+                 plugin_cache_dir=None, quiet=False, timeline=False, parallelism_history=PARALLELISM_HISTORY):
         self.terraform_path = terraform_path
         self.maintf = maintf
         self.variables = variables or {}
@@ -35,7 +55,17 @@ class Terraformer:
         self.variables_description_file = variables_description_file
         self.tfvars_files = tfvars_files
         self.backend = backend
+        self.plugin_cache_dir = plugin_cache_dir
+        self.quiet = quiet
+        self.timeline = timeline
+        self.parallelism_history = parallelism_history
+        # Timeline of the last apply, if timeline is True
+        self.last_timeline = None
         self.is_prepared = False  # Flag to check if the environment is prepared
+        # Resources to be replaced by the next apply (see taint())
+        self.replace = []
+        # Last lines of the output of the terraform commands, to report failures
+        self.output_tail = OutputTail()
 
     def prepare_environment(self):
         """Prepare the terraform environment by copying files and setting up symlinks."""
@@ -62,30 +92,67 @@ class Terraformer:
 
             self.is_prepared = True  # Mark as prepared
 
-    def init(self):
+    def init(self, force=True):
+        """Run terraform init
+
+        Keyword arguments:
+        force - If False, run it only if it was never run successfully at the terraform path or
+                the lock file, module and provider sources, backends or backend symlink changed
+                since then (see terracumber.fingerprint.needs_init())
+        """
         self.prepare_environment()  # Ensure environment is prepared
-        """Run terraform init"""
-        return self.__run_command([self.terraform_bin, "init"])
+        if not force and not needs_init(self.terraform_path, self.get_init_fingerprint()):
+            self.__print("Nothing changed since the last terraform init, skipping it")
+            return 0
+        if self.plugin_cache_dir:
+            makedirs(self.plugin_cache_dir, exist_ok=True)
+            # Other jobs can be installing the same providers to the shared cache
+            with FileLock(self.plugin_cache_dir + '/.terracumber.lock'):
+                result = self.__run_command([self.terraform_bin, "init"])
+        else:
+            result = self.__run_command([self.terraform_bin, "init"])
+        if result == 0:
+            save_init(self.terraform_path, self.get_init_fingerprint())
+        return result
+
+    def get_init_fingerprint(self):
+        """Get a hash of the inputs for init (see terracumber.fingerprint)"""
+        return get_init_fingerprint(self.terraform_path, self.terraform_bin, self.plugin_cache_dir)
 
-    def taint(self, what):
+    def taint(self, what, replace=False):
         self.prepare_environment()  # Ensure environment is prepared
         """Taint resources according to a regex
 
         Keywords arguments:
         what - A regex expression
+        replace - If True, do not run terraform taint for each resource, but replace all of
+                  them with the next apply (-replace=), so terraform runs only once. Data
+                  sources are skipped, as they cannot be replaced
         """
         resources = self.__get_resources(what)
         for resource in resources:
-            print(resource)
-            self.__run_command([self.terraform_bin, "taint", "%s" % resource])
+            self.__print(resource)
+            if not replace:
+                self.__run_command([self.terraform_bin, "taint", "%s" % resource])
+            elif not re.match(DATA_SOURCE_ADDRESS, resource):
+                self.replace.append(resource)
 
-    def apply(self, parallelism=10, use_tf_resource_cleaner=False, tf_resources_to_keep=[], delete_all=False):
+    def apply(self, parallelism=10, use_tf_resource_cleaner=False, tf_resources_to_keep=[], delete_all=False,
+              unchanged_inputs='apply'):
         """Run terraform apply after removing unselected resources from the tfvars.
 
         parallelism - Define the number of parallel resource operations. Defaults to 10 as specified by terraform.
+                      'auto' to choose it from the previous full applies for the same backend and a
+                      similar number of resources and the load of the host, recording the duration of
+                      this one if it creates the whole environment (see
+                      terracumber.parallelism.ParallelismAdvisor)
         use_tf_resource_cleaner - Option to enable or disable the resource cleaner mechanism
         tf_resources_to_keep - List of minions to keep. If not minions are declared, all minions are going to be removed.
         delete_all - Active action to delete proxy, monitoring-server or retail ( build and terminal minions)
+        unchanged_inputs - What to do when the inputs (main.tf, tfvars, sumaform commit, variables...) and the
+                           state are the same as after the last successful apply: 'apply' to apply anyway,
+                           'plan' to run terraform plan and only apply the saved plan if there are changes,
+                           'skip' to do nothing. Ignored if there are resources to replace
         """
         self.prepare_environment()  # Ensure environment is prepared
 
@@ -99,41 +166,105 @@ class Terraformer:
                         remove_unselected_tfvars_resources(target_file, tf_resources_to_keep, delete_all)
                     processed_files.add(basename)
 
-        command_arguments = [self.terraform_bin, "apply", "-auto-approve", f"-parallelism={parallelism}"]
+        inputs = self.get_inputs_fingerprint()
+        unchanged = unchanged_inputs != 'apply' and not self.replace and is_unchanged(self.terraform_path, inputs)
+        if unchanged and unchanged_inputs == 'skip':
+            self.__print("Inputs did not change since the last successful apply, skipping it")
+            return 0
+
+        advisor = None
+        if parallelism == 'auto':
+            resources = len(self.__get_resources())
+            advisor = ParallelismAdvisor(self.backend, resources, self.parallelism_history, self.terraform_path)
+            parallelism, reason = advisor.choose()
+            self.__print("Using parallelism %d: %s" % (parallelism, reason))
+            # Only full applies are recorded: not the ones applying a saved plan or changing an
+            # existing environment
+            if unchanged or resources:
+                advisor = None
+
+        if unchanged:
+            self.__print("Inputs did not change since the last successful apply, checking for changes")
+            result = self.plan(parallelism)
+            if result != 2:
+                return result
+            command_arguments = [self.terraform_bin, "apply", "-auto-approve", f"-parallelism={parallelism}",
+                                 PLAN_FILE]
+        else:
+            command_arguments = [self.terraform_bin, "apply", "-auto-approve", f"-parallelism={parallelism}"]
+            for file in self.tfvars_files:
+                command_arguments.append(f"-var-file={file}")
+            for resource in self.replace:
+                command_arguments.append(f"-replace={resource}")
+            self.replace = []
+        start = monotonic()
+        if self.timeline:
+            command_arguments.insert(2, "-json")
+            self.last_timeline = Timeline()
+            try:
+                result = self.__run_command(command_arguments, timeline=self.last_timeline)
+            finally:
+                self.last_timeline.save(self.get_timeline_file())
+        else:
+            result = self.__run_command(command_arguments)
+        if advisor:
+            advisor.record(parallelism, monotonic() - start, result, len(self.__get_resources()))
+        if result == 0:
+            save_fingerprint(self.terraform_path, inputs)
+        else:
+            forget_fingerprint(self.terraform_path)
+        return result
+
+    def plan(self, parallelism=10):
+        """Run terraform plan, saving the plan to PLAN_FILE at the terraform path
+
+        Returns 0 if there are no changes, 2 if there are changes and any other value for errors
+        """
+        command_arguments = [self.terraform_bin, "plan", "-detailed-exitcode", "-input=false",
+                             f"-out={PLAN_FILE}", f"-parallelism={parallelism}"]
         for file in self.tfvars_files:
             command_arguments.append(f"-var-file={file}")
         return self.__run_command(command_arguments)
 
+    def get_timeline_file(self):
+        """Get the path for the timeline of the last apply: the output file with
+        .timeline.json instead of its extension, or at the terraform path without output file"""
+        if not self.output_file:
+            return path.join(self.terraform_path, 'terracumber.timeline.json')
+        return path.splitext(self.output_file)[0] + '.timeline.json'
+
+    def get_inputs_fingerprint(self):
+        """Get a hash of the inputs for apply (see terracumber.fingerprint)"""
+        files = ['main.tf', 'variables.tf', '.terraform.lock.hcl'] + self.tfvars_files
+        return get_inputs_fingerprint(self.terraform_path, files, self.variables, self.terraform_bin)
+
     def destroy(self):
         """Run terraform destroy"""
+        # Everything is created again, and resources not at the state cannot be replaced
+        self.replace = []
         command_arguments = [self.terraform_bin, "destroy", "-auto-approve"]
         for file in self.tfvars_files:
             command_arguments.append("-var-file=%s" % file)
         self.__run_command(command_arguments)
 
+    def get_tfstate(self):
+        """Get the TfState for the tfstate file, shared by all the objects for the same path"""
+        return get_tfstate(self.terraform_path + '/terraform.tfstate')
+
     def get_hostname(self, resource):
         """Get a hostname for an instance from the tfstate file"""
-        with open(self.terraform_path + '/terraform.tfstate', 'r') as tf_state:
-            j = load(tf_state)
-            # This seems to be sumaform specific. I wonder if there is
-            # a way of making this generic :-(
-            value = j['outputs']['configuration']['value']
-            if resource in value.keys():
-                if 'hostnames' in value[resource].keys():
-                    return value[resource]['hostnames'][0]
-                if 'hostname' in value[resource].keys():
-                    return value[resource]['hostname']
+        # This seems to be sumaform specific. I wonder if there is
+        # a way of making this generic :-(
+        hostnames = self.get_tfstate().get_hostnames(resource)
+        if hostnames:
+            return hostnames[0]
         return None
 
     def get_single_node_ipaddr(self):
         """Get the hostname for a single node from tfstate file"""
-        with open(self.terraform_path + '/terraform.tfstate', 'r') as tf_state:
-            j = load(tf_state)
-            # This seems to be sumaform specific. I wonder if there is
-            # a way of making this generic :-(
-            value = j['outputs']['configuration']['value']
-            if 'ipaddrs' in value.keys():
-                return value['ipaddrs'][0][0]
+        ipaddrs = self.get_tfstate().get_ipaddrs()
+        if ipaddrs:
+            return ipaddrs[0][0]
         return None
 
     def __get_resources(self, what=None):
@@ -142,37 +273,51 @@ class Terraformer:
         """
         if not path.isfile(self.terraform_path + '/terraform.tfstate'):
             return []
-        # We should use the terraform.tf state file for this, but then we
-        # would need a way more complicated code, as you can't get the
-        # addresses from the file without transformations depending
-        # on the resource type.
-        all_resources = self.__run_command(
-            [self.terraform_bin, "state", "list"], True)
+        # The addresses are built from the tfstate file as terraform state list does,
+        # falling back to running it for state formats not supported
+        try:
+            all_resources = list_addresses(self.terraform_path + '/terraform.tfstate')
+        except (ValueError, KeyError):
+            all_resources = self.__run_command(
+                [self.terraform_bin, "state", "list"], True)
         if not what:
             return all_resources
-        filtered_resources = []
-        for resource in all_resources:
-            if match(what, resource):
-                filtered_resources.append(resource)
-        return filtered_resources
-
-    def __run_command(self, command, get_output=False):
-        """Run an arbitary command locally. Optionally, store the output to a file. """
+        regex = re.compile(what)
+        return [resource for resource in all_resources if regex.match(resource)]
+
+    def __print(self, message):
+        """Print a message to the console, or only to the output file if quiet"""
+        if not self.quiet:
+            print(message)
+        elif self.output_file:
+            with open(self.output_file, 'a') as output_file:
+                output_file.write(message + '\n')
+
+    def __run_command(self, command, get_output=False, timeline=None):
+        """Run an arbitary command locally. Optionally, store the output to a file.
+        With a Timeline, the output is terraform -json and each line is converted by it"""
         if get_output:
             output = []
             output_file = None
         else:
             output_file = open(self.output_file, 'a')
         try:
+            env = merge_two_dicts(environ, self.variables)
+            if self.plugin_cache_dir:
+                env['TF_PLUGIN_CACHE_DIR'] = self.plugin_cache_dir
             process = Popen(command, stdout=PIPE, stderr=STDOUT, cwd=self.terraform_path,
-                            universal_newlines=True, env=merge_two_dicts(environ, self.variables))
+                            universal_newlines=True, env=env)
             for stdout_line in self.__run_command_iterator(process):
                 if get_output:
                     output.append(stdout_line.rstrip())
                     continue
+                if timeline is not None:
+                    stdout_line = timeline.feed(stdout_line)
+                self.output_tail.feed(stdout_line)
                 if output_file:
                     output_file.write(stdout_line)
-                    print(stdout_line, end='')
+                    if not self.quiet:
+                        print(stdout_line, end='')
             process.stdout.close()
             return_code = process.wait()
             if return_code:
@@ -0,0 +1,236 @@
+"""Read the outputs from terraform state files"""
+import json
+import re
+from os import path, stat
+from threading import Lock
+
+# Characters read at once from the state file
+READ_SIZE = 1024 * 1024
+# Characters with a meaning outside and inside JSON strings
+STRUCTURE = re.compile(r'[{}\[\]"]')
+STRING_END = re.compile(r'["\\]')
+# A module at the address of a module instance, with its name and its key if any
+MODULE = re.compile(r'module\.([^.\[]+)(?:\[(\d+|"(?:[^"\\]|\\.)*")\])?')
+
+
+def get_key_order(key):
+    """Return a value to sort instance keys as terraform does: no key first, then integer
+    keys and then string keys"""
+    if key is None:
+        return (0, 0, '')
+    if isinstance(key, int):
+        return (1, key, '')
+    return (2, 0, key)
+
+
+def format_key(key):
+    """Return the instance key as it is written at an address"""
+    if key is None:
+        return ''
+    if isinstance(key, int):
+        return '[%d]' % key
+    return '[%s]' % json.dumps(key, ensure_ascii=False)
+
+
+def get_module_order(module):
+    """Return a value to sort module instance addresses as terraform does: shorter paths
+    first, then by the name and key of each module"""
+    segments = []
+    for name, key in MODULE.findall(module or ''):
+        if key:
+            key = json.loads(key)
+        segments.append((name, get_key_order(key if key != '' else None)))
+    return (len(segments), segments)
+
+
+def list_addresses(filename):
+    """Return the addresses of the resource instances at a terraform state file, in the same
+    format and order as terraform state list
+
+    ValueError is raised for a state file not using format version 4, as written by
+    terraform 0.12 and later.
+    """
+    with open(filename, 'r', encoding='utf-8') as tf_state:
+        state = json.load(tf_state)
+    if state.get('version') != 4:
+        raise ValueError('%s uses the unsupported state format version %s' % (filename, state.get('version')))
+    addresses = []
+    for resource in state.get('resources', []):
+        module = resource.get('module', '')
+        prefix = module + '.' if module else ''
+        if resource['mode'] == 'data':
+            prefix += 'data.'
+        prefix += '%s.%s' % (resource['type'], resource['name'])
+        resource_order = (get_module_order(module), resource['mode'] != 'data', resource['type'],
+                          resource['name'])
+        for instance in resource.get('instances', []):
+            key = instance.get('index_key')
+            addresses.append((resource_order + (get_key_order(key),), prefix + format_key(key)))
+    return [address for _, address in sorted(addresses)]
+
+
+def read_outputs(filename, read_size=READ_SIZE):
+    """Return the value for "outputs" at a terraform state file, None if it is not present
+
+    The file is scanned in chunks without decoding anything but the top level keys and the
+    outputs, so big sections such as "resources" are skipped cheaply, and the file is read
+    only until the outputs are found (with terraform writing them before the resources).
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    # Last string found at the top level object: the key for the next object or array
+    last_string = None
+    string_pieces = None
+    # Pieces of the outputs, while they are being read
+    outputs_pieces = None
+    with open(filename, 'r', encoding='utf-8') as tf_state:
+        while True:
+            chunk = tf_state.read(read_size)
+            if not chunk:
+                return None
+            pos = 0
+            outputs_start = 0
+            while pos < len(chunk):
+                if in_string:
+                    if escaped:
+                        # The escaped character was at the next chunk
+                        if string_pieces is not None:
+                            string_pieces.append(chunk[pos])
+                        escaped = False
+                        pos += 1
+                        continue
+                    match = STRING_END.search(chunk, pos)
+                    end = match.start() if match else len(chunk)
+                    if string_pieces is not None:
+                        string_pieces.append(chunk[pos:end])
+                    if match is None:
+                        pos = end
+                    elif match.group() == '\\':
+                        if string_pieces is not None:
+                            string_pieces.append(chunk[end:end + 2])
+                        escaped = end + 1 == len(chunk)
+                        pos = end + 2
+                    else:
+                        in_string = False
+                        if string_pieces is not None:
+                            last_string = json.loads('"%s"' % ''.join(string_pieces))
+                            string_pieces = None
+                        pos = end + 1
+                    continue
+                match = STRUCTURE.search(chunk, pos)
+                if match is None:
+                    break
+                char = match.group()
+                pos = match.end()
+                if char == '"':
+                    in_string = True
+                    if depth == 1:
+                        string_pieces = []
+                elif char in '{[':
+                    if depth == 1 and last_string == 'outputs':
+                        outputs_pieces = []
+                        outputs_start = match.start()
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1 and outputs_pieces is not None:
+                        outputs_pieces.append(chunk[outputs_start:pos])
+                        return json.loads(''.join(outputs_pieces))
+                    if depth == 0:
+                        return None
+            if outputs_pieces is not None:
+                outputs_pieces.append(chunk[outputs_start:])
+
+
+class TfState:
+    """The TfState class gives access to the outputs of a terraform state file, reading
+    them again only if the file changed (other inode, mtime or size)
+
+    Use get_tfstate() to share the object for a file, so it is read only once no matter
+    how many objects need it.
+
+    Keyword arguments:
+    filename - A string with the path to the terraform.tfstate file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.key = None
+        self.outputs = None
+        self.lock = Lock()
+
+    def get_outputs(self):
+        """Return the outputs at the state file, an empty dictionary if there are none.
+        FileNotFoundError is raised if the file does not exist"""
+        tf_state_stat = stat(self.filename)
+        key = (tf_state_stat.st_ino, tf_state_stat.st_mtime_ns, tf_state_stat.st_size)
+        with self.lock:
+            if key != self.key:
+                self.outputs = read_outputs(self.filename) or {}
+                self.key = key
+            return self.outputs
+
+    def get_configuration(self):
+        """Return the value for the configuration output (sumaform specific). KeyError is
+        raised if it is not present"""
+        return self.get_outputs()['configuration']['value']
+
+    def get_node(self, resource=None):
+        """Return the configuration for a node, None if it is not present
+
+        Keyword arguments:
+        resource - The name of the node, None for an environment with a single node
+        """
+        value = self.get_configuration()
+        if resource is None:
+            return value
+        node = value.get(resource)
+        return node if isinstance(node, dict) else None
+
+    def get_hostnames(self, resource=None):
+        """Return a list with the hostnames for a node, empty if there are none
+
+        Keyword arguments:
+        resource - The name of the node, None for an environment with a single node
+        """
+        node = self.get_node(resource) or {}
+        if 'hostnames' in node:
+            return node['hostnames']
+        if 'hostname' in node:
+            return [node['hostname']]
+        return []
+
+    def get_ipaddrs(self, resource=None):
+        """Return a list with the IP addresses for a node, empty if there are none. Each
+        element is a list with the addresses for one of the hosts of the node
+
+        Keyword arguments:
+        resource - The name of the node, None for an environment with a single node
+        """
+        node = self.get_node(resource) or {}
+        return node.get('ipaddrs', [])
+
+    def get_nodes(self):
+        """Return a dictionary with {'hostnames': [...], 'ipaddrs': [...]} for each node
+        with hostnames at the configuration"""
+        nodes = {}
+        for resource, node in self.get_configuration().items():
+            if isinstance(node, dict) and ('hostnames' in node or 'hostname' in node):
+                nodes[resource] = {'hostnames': self.get_hostnames(resource),
+                                   'ipaddrs': self.get_ipaddrs(resource)}
+        return nodes
+
+
+# TfState objects by the absolute path of their files
+tfstates = {}
+tfstates_lock = Lock()
+
+
+def get_tfstate(filename):
+    """Return the TfState object for a state file, creating it on first use"""
+    with tfstates_lock:
+        key = path.abspath(filename)
+        if key not in tfstates:
+            tfstates[key] = TfState(filename)
+        return tfstates[key]
@@ -0,0 +1,93 @@
+"""Build a timeline of the resources from the machine readable output of terraform (-json)"""
+import json
+from datetime import datetime
+
+# Formats for @timestamp, with and without fractions of a second
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z')
+
+
+def parse_timestamp(timestamp):
+    """Return a datetime for a @timestamp of an event, None if it cannot be parsed"""
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(timestamp, timestamp_format)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def format_event(event):
+    """Return the human readable text for an event, as terraform prints it without -json"""
+    message = event.get('@message', '')
+    detail = event.get('diagnostic', {}).get('detail') if event.get('type') == 'diagnostic' else None
+    if detail:
+        message += '\n\n' + detail
+    return message + '\n'
+
+
+class Timeline:
+    """The Timeline class reads the events of terraform apply -json line by line, keeping
+    the start, end and duration of each operation on each resource (a replaced resource
+    has a delete and a create operation)
+    """
+
+    def __init__(self):
+        # Operations by (address, action), in the order they started
+        self.operations = {}
+
+    def feed(self, line):
+        """Add a line of the output, returning it as human readable text. Lines that are
+        not terraform events (i.e. a crash of a provider) are returned as they are"""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return line
+        if not isinstance(event, dict) or '@message' not in event:
+            return line
+        event_type = event.get('type')
+        if event_type in ('apply_start', 'apply_complete', 'apply_errored'):
+            self.add_event(event_type, event)
+        return format_event(event)
+
+    def add_event(self, event_type, event):
+        """Update the operation for an apply_start, apply_complete or apply_errored event"""
+        hook = event.get('hook', {})
+        address = hook.get('resource', {}).get('addr')
+        if not address:
+            return
+        key = (address, hook.get('action'))
+        if event_type == 'apply_start':
+            self.operations.pop(key, None)
+            self.operations[key] = {'address': address, 'action': hook.get('action'),
+                                    'start': event.get('@timestamp'), 'end': None, 'seconds': None,
+                                    'status': 'running'}
+            return
+        operation = self.operations.setdefault(key, {'address': address, 'action': hook.get('action'),
+                                                     'start': None})
+        operation['end'] = event.get('@timestamp')
+        operation['status'] = 'complete' if event_type == 'apply_complete' else 'errored'
+        start = parse_timestamp(operation['start'])
+        end = parse_timestamp(operation['end'])
+        if start and end:
+            operation['seconds'] = (end - start).total_seconds()
+        else:
+            operation['seconds'] = hook.get('elapsed_seconds')
+
+    def get_operations(self):
+        """Return a list with a dictionary for each operation (address, action, start, end,
+        seconds and status: running, complete or errored), in the order they started"""
+        return list(self.operations.values())
+
+    def get_slowest(self, number=10):
+        """Return a list with the slowest finished operations, slowest first
+
+        Keyword arguments:
+        number - The maximum number of operations to return
+        """
+        finished = [operation for operation in self.operations.values() if operation['seconds'] is not None]
+        return sorted(finished, key=lambda operation: operation['seconds'], reverse=True)[:number]
+
+    def save(self, filename):
+        """Write the operations to a JSON file"""
+        with open(filename, 'w') as timeline_file:
+            json.dump(self.get_operations(), timeline_file, indent=2)
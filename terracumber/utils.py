@@ -1,4 +1,10 @@
 """Common tools"""
+import fcntl
+import re
+from collections import deque
+
+# Maximum length kept for a line that did not end yet
+MAX_PARTIAL_LINE = 64 * 1024
 
 
 def overwrite_dict(dict_x, dict_y):
@@ -20,3 +26,69 @@ def merge_two_dicts(dict_x, dict_y):
     # modifies dict_z with dict_y's keys and values & returns None
     dict_z.update(dict_y)
     return dict_z
+
+
+class FileLock:
+    """The FileLock class is a context manager holding an exclusive lock on a file, so
+    processes sharing something (i.e. a cache directory) do not use it at the same time
+
+    Keyword arguments:
+    filename - A string with the path for the lock file, created if it does not exist
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.filename, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+class OutputTail:
+    """The OutputTail class keeps the last lines of a command output in memory, so they
+    can be reported without reading the log file again
+
+    Keyword arguments:
+    lines - The maximum number of lines to keep
+    error_regex - Optional regex. The last `lines` lines matching it are kept separately,
+                  even if they are not part of the last lines of the output
+    """
+
+    def __init__(self, lines=50, error_regex=None):
+        self.lines = deque(maxlen=lines)
+        self.errors = deque(maxlen=lines)
+        self.error_regex = re.compile(error_regex) if error_regex else None
+        self.partial = ''
+
+    def feed(self, text):
+        """Add a chunk of output, not necessarily ending at a line boundary"""
+        new_lines = (self.partial + text).split('\n')
+        # Do not let a never ending line (i.e. progress bars using \r) grow without limits
+        self.partial = new_lines.pop()[-MAX_PARTIAL_LINE:]
+        if self.error_regex:
+            for line in new_lines:
+                if self.error_regex.search(line):
+                    self.errors.append(line.rstrip('\r'))
+        elif len(new_lines) > self.lines.maxlen:
+            # Only the last lines would survive anyway
+            new_lines = new_lines[len(new_lines) - self.lines.maxlen:]
+        for line in new_lines:
+            self.lines.append(line.rstrip('\r'))
+
+    def get_lines(self):
+        """Return a list with the last lines, including an unfinished last line"""
+        lines = list(self.lines)
+        if self.partial:
+            lines.append(self.partial.rstrip('\r'))
+        return lines[len(lines) - self.lines.maxlen:] if self.lines.maxlen else []
+
+    def get_errors(self):
+        """Return a list with the last lines matching error_regex"""
+        return list(self.errors)
@@ -0,0 +1,51 @@
+"""Compare serial and parallel parsing of junit output XML files
+
+Usage: python3 -m test.benchmark_junit [TESTCASES_PER_FILE] [PROCESSES]
+
+For an increasing number of files, print the time needed to get the totals with one
+process and with PROCESSES processes (one per CPU by default). The crossover point is
+used for terracumber.junit.PARALLEL_THRESHOLD.
+"""
+import os
+import sys
+import tempfile
+import time
+from terracumber import junit
+
+
+def write_files(folder, files, testcases):
+    """Write `files` junit output XML files with `testcases` testcases each"""
+    for number in range(files):
+        with open(os.path.join(folder, 'TEST-features-%s.xml' % number), 'w') as tfile:
+            tfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            tfile.write('<testsuite failures="1" errors="0" skipped="0" tests="%s" time="1.0" name="f%s">\n'
+                        % (testcases, number))
+            for testcase in range(testcases):
+                tfile.write('<testcase classname="Feature %s" name="Scenario %s" time="0.1">\n'
+                            % (number, testcase))
+                if testcase == 0:
+                    tfile.write('<failure message="failed Scenario %s" type="failed"/>\n' % testcase)
+                tfile.write('<system-out><![CDATA[%s]]></system-out>\n</testcase>\n' % ('x' * 200))
+            tfile.write('</testsuite>\n')
+
+
+def measure(folder, processes):
+    """Return the seconds needed to get the totals from an empty cache"""
+    start = time.monotonic()
+    junit.Junit(folder, processes=processes, parallel_threshold=0).get_totals()
+    return time.monotonic() - start
+
+
+def main():
+    testcases = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    print("%s testcases per file, %s processes" % (testcases, processes))
+    print("%8s %10s %10s" % ('files', 'serial', 'parallel'))
+    for files in [4, 8, 16, 32, 64, 128, 256, 512]:
+        with tempfile.TemporaryDirectory() as folder:
+            write_files(folder, files, testcases)
+            print("%8s %9.3fs %9.3fs" % (files, measure(folder, 1), measure(folder, processes)))
+
+
+if __name__ == '__main__':
+    main()
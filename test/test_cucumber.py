@@ -1,5 +1,11 @@
 from terracumber import cucumber
+import io
+import json
+import os
 import stat
+import tarfile
+import tempfile
+import threading
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -10,18 +16,39 @@ class TestCucumber(unittest.TestCase):
 
     @patch('terracumber.cucumber.paramiko.SSHClient')
     @patch('builtins.open')
-    def test_run_command(self, mock_open, mock_sshclient):
+    @patch('terracumber.cucumber.sys.stdout')
+    def test_run_command(self, mock_stdout, mock_open, mock_sshclient):
         self.cucumber = cucumber.Cucumber(self.conn_data)
-        mock_sshclient.return_value.get_transport.return_value.open_session.return_value.recv_exit_status.return_value = 0
+        mock_chan = mock_sshclient.return_value.get_transport.return_value.open_session.return_value
+        mock_chan.recv.return_value = b''
+        mock_chan.recv_exit_status.return_value = 0
         self.assertEqual(self.cucumber.run_command('true'), 0)
-        mock_sshclient.return_value.get_transport.return_value.open_session.return_value.recv_exit_status.return_value = 1
+        mock_chan.recv_exit_status.return_value = 1
         self.assertEqual(self.cucumber.run_command('false'), 1)
-        mock_sshclient.return_value.get_transport.return_value.open_session.return_value.makefile.return_value = [
-            'VAR=555']
+        mock_chan.recv.side_effect = [b'VAR=5', b'55\r\n\xc3', b'\xb1\r\n', b'']
         self.cucumber.run_command('echo VAR=$VAR', {'VAR': '555'}, '/tmp/data.json')
-        mock_open.assert_called_with('/tmp/data.json', 'a')
-        mock_open.return_value.write.assert_called_with('VAR=555')
+        mock_open.assert_called_with('/tmp/data.json', 'a', buffering=cucumber.OUTPUT_BUFFER_SIZE)
+        self.assertEqual(''.join(call.args[0] for call in mock_open.return_value.write.call_args_list),
+                         'VAR=555\r\n\u00f1\r\n')
         mock_open.return_value.close.assert_called()
+        self.assertEqual(''.join(call.args[0] for call in mock_stdout.write.call_args_list),
+                         'VAR=555\n\u00f1\n')
+        self.assertEqual(self.cucumber.last_run_stats['bytes'], 13)
+        self.assertListEqual(self.cucumber.output_tail.get_lines(), ['VAR=555', '\u00f1'])
+        # Quiet mode only writes to the file
+        mock_stdout.reset_mock()
+        mock_open.reset_mock()
+        mock_chan.recv.side_effect = [b'VAR=555\r\n', b'']
+        self.cucumber.run_command('echo VAR=$VAR', {'VAR': '555'}, '/tmp/data.json', quiet=True)
+        mock_open.return_value.write.assert_called_once_with('VAR=555\r\n')
+        mock_stdout.write.assert_not_called()
+        # An incomplete character at the end of the output is not lost
+        mock_open.reset_mock()
+        mock_chan.recv.side_effect = [b'done \xc3', b'']
+        self.cucumber.run_command('echo done', output_file='/tmp/data.json', quiet=True)
+        self.assertEqual(''.join(call.args[0] for call in mock_open.return_value.write.call_args_list),
+                         'done \ufffd')
+        self.assertListEqual(self.cucumber.output_tail.get_lines()[-1:], ['done \ufffd'])
 
     @patch('terracumber.cucumber.paramiko.SSHClient')
     @patch('terracumber.cucumber.paramiko.sftp_attr')
@@ -34,6 +61,32 @@ class TestCucumber(unittest.TestCase):
         self.cucumber.copy_atime_mtime('/remote_path/file', '/local_path/file')
         mock_utime.assert_called_with('/local_path/file', (1, 2))
 
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    @patch('terracumber.cucumber.os.utime')
+    def test_copy_atime_mtime_with_attributes(self, mock_utime, mock_sshclient):
+        attributes = MagicMock(st_atime=3, st_mtime=4)
+        self.cucumber = cucumber.Cucumber(self.conn_data)
+        self.cucumber.copy_atime_mtime('/remote_path/file', '/local_path/file', attributes)
+        mock_utime.assert_called_with('/local_path/file', (3, 4))
+        mock_sshclient.return_value.open_sftp.assert_not_called()
+        self.assertEqual(self.cucumber.roundtrips_saved, 1)
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_get_sftp_client(self, mock_sshclient):
+        self.cucumber = cucumber.Cucumber(self.conn_data)
+        self.assertIs(self.cucumber.get_sftp_client(), self.cucumber.get_sftp_client())
+        mock_sshclient.return_value.open_sftp.assert_called_once()
+        self.assertEqual(self.cucumber.roundtrips_saved, 1)
+        # Other threads get their own session
+        thread = threading.Thread(target=self.cucumber.get_sftp_client)
+        thread.start()
+        thread.join()
+        self.assertEqual(mock_sshclient.return_value.open_sftp.call_count, 2)
+        self.assertEqual(len(self.cucumber.sftp_clients), 2)
+        self.cucumber.close()
+        self.assertEqual(mock_sshclient.return_value.open_sftp.return_value.close.call_count, 2)
+        self.assertListEqual(self.cucumber.sftp_clients, [])
+
     @patch('terracumber.cucumber.paramiko.SSHClient')
     @patch('terracumber.cucumber.Cucumber.copy_atime_mtime')
     def test_get(self, mock_copy_atime_mtime, mock_sshclient):
@@ -118,6 +171,270 @@ class TestCucumber(unittest.TestCase):
         self.assertEqual(result, [])
         mock_sftp.get.assert_not_called()
 
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    @patch('terracumber.cucumber.Cucumber.copy_atime_mtime')
+    def test_download_files_parallel(self, mock_copy_atime_mtime, mock_sshclient):
+        mock_sshclient.return_value.open_sftp.side_effect = lambda: MagicMock()
+        self.cucumber = cucumber.Cucumber(self.conn_data, transfer_workers=4)
+        files = [('/remote/file%s' % i, '/local/file%s' % i, MagicMock()) for i in range(20)]
+        self.cucumber.download_files(files)
+        self.assertEqual(mock_copy_atime_mtime.call_count, 20)
+        self.assertListEqual(sorted(call.args[0] for call in mock_copy_atime_mtime.call_args_list),
+                             sorted(remote_path for remote_path, _, _ in files))
+        # The SFTP sessions are pooled, never more than one per worker
+        self.assertLessEqual(self.cucumber.sftp_pool_size, 4)
+        self.assertEqual(self.cucumber.sftp_pool.qsize(), self.cucumber.sftp_pool_size)
+        self.cucumber.close()
+        self.assertTrue(self.cucumber.sftp_pool.empty())
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_download_files_parallel_error(self, mock_sshclient):
+        mock_sshclient.return_value.open_sftp.return_value.get.side_effect = IOError
+        self.cucumber = cucumber.Cucumber(self.conn_data, transfer_workers=2)
+        with self.assertRaises(IOError):
+            self.cucumber.download_files([('/remote/a', '/local/a', MagicMock()),
+                                          ('/remote/b', '/local/b', MagicMock())])
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_fetch_file_sync(self, mock_sshclient):
+        class RemoteFile(io.BytesIO):
+            def prefetch(self, file_size=None):
+                pass
+
+        remote_data = b'0123456789'
+        attributes = MagicMock(st_size=len(remote_data), st_atime=1000, st_mtime=2000)
+        mock_sftp = MagicMock()
+        mock_sftp.open.side_effect = lambda path, mode: RemoteFile(remote_data)
+
+        def interrupted_get(remote, local, callback=None):
+            with open(local, 'wb') as l_file:
+                l_file.write(remote_data[:4])
+            raise IOError
+
+        mock_sftp.get.side_effect = interrupted_get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'transfer_manifest.json')
+            local_path = os.path.join(tmpdir, 'file')
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            with self.assertRaises(IOError):
+                self.cucumber.fetch_file(mock_sftp, '/remote/file', local_path, attributes)
+            self.cucumber.save_manifest()
+            with open(manifest, 'r') as m_file:
+                self.assertDictEqual(json.load(m_file)['files'],
+                                     {'file': {'remote': '/remote/file', 'size': 10, 'mtime': 2000,
+                                               'complete': False}})
+            # The interrupted download is resumed by a later run
+            mock_sftp.get.reset_mock()
+            mock_sftp.get.side_effect = lambda remote, local, callback: open(local, 'wb').write(remote_data)
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            self.cucumber.fetch_file(mock_sftp, '/remote/file', local_path, attributes)
+            with open(local_path, 'rb') as l_file:
+                self.assertEqual(l_file.read(), remote_data)
+            mock_sftp.get.assert_not_called()
+            # Complete file is skipped
+            self.cucumber.fetch_file(mock_sftp, '/remote/file', local_path, attributes)
+            mock_sftp.get.assert_not_called()
+            self.assertDictEqual(self.cucumber.sync_stats, {'downloaded': 0, 'skipped': 1, 'resumed': 1})
+            # Only the resumed part was received
+            self.assertEqual(self.cucumber.get_received_bytes([tmpdir]), 6)
+            # A file recorded as complete is downloaded again if the remote changed
+            self.cucumber.save_manifest()
+            with open(manifest, 'r') as m_file:
+                self.assertDictEqual(json.load(m_file)['files'],
+                                     {'file': {'remote': '/remote/file', 'size': 10, 'mtime': 2000,
+                                               'complete': True}})
+            attributes = MagicMock(st_size=len(remote_data) + 1, st_atime=1000, st_mtime=3000)
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            self.cucumber.fetch_file(mock_sftp, '/remote/file', local_path, attributes)
+            self.assertEqual(mock_sftp.get.call_args.args, ('/remote/file', local_path))
+            self.assertEqual(os.stat(local_path).st_mtime, 3000)
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_fetch_file_sync_not_interrupted(self, mock_sshclient):
+        remote_data = b'NEW-REPORT-REGENERATED'
+        attributes = MagicMock(st_size=len(remote_data), st_atime=1000, st_mtime=2000)
+        mock_sftp = MagicMock()
+
+        def get(remote, local, callback):
+            with open(local, 'wb') as l_file:
+                l_file.write(remote_data)
+            callback(len(remote_data), len(remote_data))
+
+        mock_sftp.get.side_effect = get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'transfer_manifest.json')
+            local_path = os.path.join(tmpdir, 'report')
+            # Smaller local file not left by an interrupted download (i.e. from an older run)
+            with open(local_path, 'wb') as l_file:
+                l_file.write(b'OLD-REPORT')
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            self.cucumber.fetch_file(mock_sftp, '/remote/report', local_path, attributes)
+            mock_sftp.open.assert_not_called()
+            with open(local_path, 'rb') as l_file:
+                self.assertEqual(l_file.read(), remote_data)
+            self.assertDictEqual(self.cucumber.sync_stats, {'downloaded': 1, 'skipped': 0, 'resumed': 0})
+            self.assertEqual(self.cucumber.get_received_bytes([local_path]), len(remote_data))
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_share_transfers(self, mock_sshclient):
+        mock_sftp = MagicMock()
+
+        def get(remote, local, callback):
+            with open(local, 'wb') as l_file:
+                callback(l_file.write(b'data'), 4)
+
+        mock_sftp.get.side_effect = get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'transfer_manifest.json')
+            first = cucumber.Cucumber(self.conn_data, transfer_workers=2, sync=True, manifest=manifest)
+            second = cucumber.Cucumber(self.conn_data)
+            second.share_transfers(first)
+            self.assertEqual(second.transfer_workers, 2)
+            for connection, name in [(first, 'a'), (second, 'b')]:
+                connection.fetch_file(mock_sftp, '/remote/' + name, os.path.join(tmpdir, name),
+                                      MagicMock(st_size=4, st_atime=1000, st_mtime=2000))
+            # Both files at the same manifest and counters
+            second.save_manifest()
+            with open(manifest, 'r') as m_file:
+                self.assertListEqual(sorted(json.load(m_file)['files']), ['a', 'b'])
+            self.assertEqual(first.sync_stats['downloaded'], 2)
+            self.assertEqual(first.get_received_bytes([os.path.join(tmpdir, 'b')]), 4)
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    @patch('terracumber.cucumber.RESUME_MIN_SIZE', 4)
+    def test_fetch_file_sync_manifest_saved(self, mock_sshclient):
+        attributes = MagicMock(st_size=10, st_atime=1000, st_mtime=2000)
+        mock_sftp = MagicMock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'transfer_manifest.json')
+
+            def get(remote, local, callback):
+                # The download in progress is at the manifest, even if the process is killed now
+                with open(manifest, 'r') as m_file:
+                    self.assertFalse(json.load(m_file)['files']['file']['complete'])
+                with open(local, 'wb') as l_file:
+                    l_file.write(b'0123456789')
+
+            mock_sftp.get.side_effect = get
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            self.cucumber.fetch_file(mock_sftp, '/remote/file', os.path.join(tmpdir, 'file'), attributes)
+            mock_sftp.get.assert_called_once()
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_get_tar(self, mock_sshclient):
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+            for name, mode in [('./screenshot.png', 0o640), ('./subdir/log.txt', 0o600)]:
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                info.mode = mode
+                info.mtime = 1234567890
+                tar.addfile(info, io.BytesIO(b'data'))
+        stream.seek(0)
+        mock_chan = mock_sshclient.return_value.get_transport.return_value.open_session.return_value
+        mock_chan.makefile.return_value = stream
+        mock_chan.recv_exit_status.return_value = 0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'transfer_manifest.json')
+            self.cucumber = cucumber.Cucumber(self.conn_data, sync=True, manifest=manifest)
+            localdir = os.path.join(tmpdir, 'screenshots')
+            self.cucumber.get_tar('/remote/screenshots', localdir, compress=True)
+            mock_chan.exec_command.assert_called_once_with('tar -C /remote/screenshots -czf - .')
+            local_file = os.path.join(localdir, 'subdir', 'log.txt')
+            with open(local_file, 'rb') as l_file:
+                self.assertEqual(l_file.read(), b'data')
+            self.assertEqual(os.stat(local_file).st_mtime, 1234567890)
+            self.assertEqual(stat.S_IMODE(os.stat(local_file).st_mode), 0o600)
+            self.assertEqual(self.cucumber.get_received_bytes([localdir]), len(stream.getvalue()))
+            self.assertEqual(self.cucumber.get_received_bytes([os.path.join(tmpdir, 'logs')]), 0)
+            # The extracted files are recorded as complete at the manifest
+            with open(manifest, 'r') as m_file:
+                self.assertDictEqual(json.load(m_file)['files'], {
+                    'screenshots/screenshot.png': {'remote': '/remote/screenshots/screenshot.png', 'size': 4,
+                                                   'mtime': 1234567890, 'complete': True},
+                    'screenshots/subdir/log.txt': {'remote': '/remote/screenshots/subdir/log.txt', 'size': 4,
+                                                   'mtime': 1234567890, 'complete': True}})
+            # A failure at the controller is reported
+            stream.seek(0)
+            mock_chan.recv_exit_status.return_value = 2
+            with self.assertRaises(IOError):
+                self.cucumber.get_tar('/remote/screenshots', localdir, compress=True)
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    @patch('terracumber.cucumber.Cucumber.get_recursive')
+    @patch('terracumber.cucumber.Cucumber.get_tar')
+    @patch('terracumber.cucumber.Cucumber.exec_command')
+    def test_get_directory(self, mock_exec_command, mock_get_tar, mock_get_recursive, mock_sshclient):
+        self.cucumber = cucumber.Cucumber(self.conn_data)
+        # Many files: tar stream
+        mock_exec_command.return_value = (0, b'500\n')
+        self.assertEqual(self.cucumber.get_directory('/remote/logs', '/local/logs', 100), 'tar')
+        mock_get_tar.assert_called_once_with('/remote/logs', '/local/logs', False)
+        mock_get_recursive.assert_not_called()
+        # Few files: SFTP
+        mock_exec_command.return_value = (0, b'5\n')
+        self.assertEqual(self.cucumber.get_directory('/remote/logs', '/local/logs', 100), 'sftp')
+        # No tar at the controller
+        mock_exec_command.return_value = (3, b'')
+        self.assertEqual(self.cucumber.get_directory('/remote/logs', '/local/logs', 100), 'sftp')
+        # tar failed, fallback to SFTP
+        mock_exec_command.return_value = (0, b'500\n')
+        mock_get_tar.side_effect = IOError
+        self.assertEqual(self.cucumber.get_directory('/remote/logs', '/local/logs', 100), 'sftp')
+        self.assertEqual(mock_get_recursive.call_count, 3)
+        # Missing remote directory
+        mock_exec_command.return_value = (2, b'')
+        with self.assertRaises(FileNotFoundError):
+            self.cucumber.get_directory('/remote/logs', '/local/logs', 100)
+        # Disabled
+        mock_exec_command.reset_mock()
+        self.assertEqual(self.cucumber.get_directory('/remote/logs', '/local/logs'), 'sftp')
+        mock_exec_command.assert_not_called()
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.conn_data = {'hostname': 'controller', 'username': 'root', 'port': 22, 'password': 'linux'}
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_get(self, mock_sshclient):
+        mock_sshclient.side_effect = lambda: MagicMock()
+        with cucumber.ConnectionManager(False, 'AutoAddPolicy') as connections:
+            ctl = connections.get(self.conn_data)
+            # Same host, port and user: same connection, with the new transfer configuration
+            self.assertIs(connections.get(dict(self.conn_data, timeout=300), transfer_workers=4), ctl)
+            self.assertEqual(ctl.transfer_workers, 4)
+            ctl.ssh_client.connect.assert_called_once()
+            # Another host: another connection
+            minion = connections.get(dict(self.conn_data, hostname='minion'))
+            self.assertIsNot(minion, ctl)
+            # Closed connections are opened again
+            ctl.ssh_client.get_transport.return_value.is_active.return_value = False
+            self.assertIsNot(connections.get(self.conn_data), ctl)
+        minion.ssh_client.close.assert_called_once()
+        self.assertDictEqual(connections.connections, {})
+
+    @patch('terracumber.cucumber.paramiko.SSHClient')
+    def test_get_through_bastion(self, mock_sshclient):
+        mock_sshclient.side_effect = lambda: MagicMock()
+        tunnel = cucumber.BastionTunnel({'hostname': 'bastion', 'username': 'ec2-user', 'port': 2222}, False)
+        mock_transport = tunnel.ssh_client.get_transport.return_value
+        mock_transport.open_channel.side_effect = lambda *args: MagicMock()
+        connections = cucumber.ConnectionManager(False, 'AutoAddPolicy', tunnel)
+        ctl = connections.get(self.conn_data)
+        minion = connections.get(dict(self.conn_data, hostname='minion', port=2022))
+        extra = connections.open(self.conn_data)
+        mock_transport.open_channel.assert_any_call('direct-tcpip', ('controller', 22), ('bastion', 2222))
+        mock_transport.open_channel.assert_any_call('direct-tcpip', ('minion', 2022), ('bastion', 2222))
+        self.assertEqual(mock_transport.open_channel.call_count, 3)
+        # Every connection has its own forwarded channel
+        socks = [c.ssh_client.connect.call_args.kwargs['sock'] for c in [ctl, minion, extra]]
+        self.assertEqual(len(set(map(id, socks))), 3)
+        self.assertIsNone(self.conn_data.get('sock'))
+        connections.close()
+        extra.ssh_client.close.assert_called_once()
+        tunnel.ssh_client.close.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()
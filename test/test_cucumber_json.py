@@ -0,0 +1,81 @@
+from terracumber import cucumber_json
+from math import isclose
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestCucumberJson(unittest.TestCase):
+    def setUp(self):
+        self.cucumber_json = cucumber_json.CucumberJson('test/resources/cucumber_json')
+
+    def test_iter_features(self):
+        features = list(cucumber_json.iter_features(
+            'test/resources/cucumber_json/output-20240101-120000.json', read_size=16))
+        self.assertListEqual([feature['name'] for feature in features], ['Very first settings', 'Channels'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report = os.path.join(tmpdir, 'output.json')
+            with open(report, 'w') as tfile:
+                tfile.write(' [ ]\n')
+            self.assertListEqual(list(cucumber_json.iter_features(report)), [])
+            with open(report, 'w') as tfile:
+                tfile.write('[{"name": "A"}, {"name": "B"')
+            with self.assertRaises(ValueError):
+                list(cucumber_json.iter_features(report, read_size=4))
+            with open(report, 'w') as tfile:
+                json.dump({'name': 'A'}, tfile)
+            with self.assertRaises(ValueError):
+                list(cucumber_json.iter_features(report))
+
+    def test_count_scenarios(self):
+        self.assertEqual(cucumber_json.count_scenarios('test/resources/cucumber_json/output-20240101-120000.json'), 4)
+        self.assertEqual(self.cucumber_json.count_scenarios(), 4)
+        # Already parsed
+        self.cucumber_json.get_totals()
+        self.assertEqual(self.cucumber_json.count_scenarios(), 4)
+        self.assertIsNone(cucumber_json.CucumberJson('test/resources/junit/failures').count_scenarios())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report = os.path.join(tmpdir, 'output.json')
+            open(report, 'w').close()
+            self.assertEqual(cucumber_json.count_scenarios(report), 0)
+            with open(report, 'w') as tfile:
+                tfile.write('[{"name": "A", "elements": [{"type": "background"}, {"type": "scenario"}, {"type": "sc')
+            self.assertEqual(cucumber_json.count_scenarios(report), 1)
+
+    def test_get_totals(self):
+        expected_totals = {'failures': 2, 'errors': 0, 'skipped': 1, 'passed': 1, 'tests': 4, 'time': 195.0}
+        computed_totals = self.cucumber_json.get_totals()
+        self.assertTrue(isclose(expected_totals['time'], computed_totals['time']))
+        del expected_totals['time']
+        del computed_totals['time']
+        self.assertDictEqual(computed_totals, expected_totals)
+
+    def test_get_totals_no_reports(self):
+        self.assertIsNone(cucumber_json.CucumberJson('test/resources/junit/failures').get_totals())
+
+    def test_get_failures(self):
+        self.assertListEqual(self.cucumber_json.get_failures(),
+                             ['failed Set the timezone', 'failed Synchronize the channels'])
+        self.assertListEqual(self.cucumber_json.get_failures(number=1), ['failed Set the timezone'])
+        self.assertListEqual(self.cucumber_json.get_failures_saltshaker(),
+                             ['Very first settings::Set the timezone', 'Channels::Synchronize the channels'])
+        self.assertTrue(self.cucumber_json.has_failures())
+
+    def test_get_testcases(self):
+        self.assertListEqual(self.cucumber_json.get_testcases(),
+                             [('Very first settings', 'Create admin user and first organization', 5.0, 'passed'),
+                              ('Very first settings', 'Set the timezone', 65.0, 'failed'),
+                              ('Channels', 'List the channels', 4.0, 'skipped'),
+                              ('Channels', 'Synchronize the channels', 121.0, 'failed')])
+
+    def test_get_step_durations(self):
+        self.assertListEqual(self.cucumber_json.get_step_durations(number=2),
+                             [('Channels::Synchronize the channels', 'When I synchronize the channels', 120.0),
+                              ('Very first settings::Set the timezone', 'Then I should see a "Europe/Berlin" text',
+                               60.0)])
+        self.assertEqual(len(self.cucumber_json.get_step_durations()), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
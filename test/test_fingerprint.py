@@ -0,0 +1,90 @@
+from terracumber import fingerprint
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.terraform_path = tempfile.mkdtemp()
+        shutil.copy('test/resources/test.tf', os.path.join(self.terraform_path, 'main.tf'))
+        self.files = ['main.tf', 'variables.tf']
+
+    def tearDown(self):
+        shutil.rmtree(self.terraform_path)
+
+    def get_inputs(self, variables={}):
+        return fingerprint.get_inputs_fingerprint(self.terraform_path, self.files, variables, '/usr/bin/terraform')
+
+    def test_get_git_head(self):
+        git_dir = os.path.join(self.terraform_path, '.git')
+        self.assertIsNone(fingerprint.get_git_head(self.terraform_path))
+        os.makedirs(os.path.join(git_dir, 'refs', 'heads'))
+        with open(os.path.join(git_dir, 'HEAD'), 'w') as head:
+            head.write('ref: refs/heads/master\n')
+        with open(os.path.join(git_dir, 'packed-refs'), 'w') as packed_refs:
+            packed_refs.write('# pack-refs with: peeled fully-peeled sorted\n'
+                              '1111111111111111111111111111111111111111 refs/heads/master\n')
+        self.assertEqual(fingerprint.get_git_head(self.terraform_path), '1' * 40)
+        with open(os.path.join(git_dir, 'refs', 'heads', 'master'), 'w') as ref:
+            ref.write('2' * 40 + '\n')
+        self.assertEqual(fingerprint.get_git_head(self.terraform_path), '2' * 40)
+        with open(os.path.join(git_dir, 'HEAD'), 'w') as head:
+            head.write('3' * 40 + '\n')
+        self.assertEqual(fingerprint.get_git_head(self.terraform_path), '3' * 40)
+
+    def test_get_inputs_fingerprint(self):
+        inputs = self.get_inputs()
+        self.assertEqual(self.get_inputs(), inputs)
+        self.assertNotEqual(self.get_inputs({'CUCUMBER_BRANCH': 'test'}), inputs)
+        with patch.dict(os.environ, {'TF_VAR_CUCUMBER_BRANCH': 'test'}):
+            self.assertNotEqual(self.get_inputs(), inputs)
+        with open(os.path.join(self.terraform_path, 'variables.tf'), 'w') as variables:
+            variables.write('variable "CUCUMBER_BRANCH" {}\n')
+        self.assertNotEqual(self.get_inputs(), inputs)
+
+    def test_is_unchanged(self):
+        inputs = self.get_inputs()
+        self.assertFalse(fingerprint.is_unchanged(self.terraform_path, inputs))
+        with open(os.path.join(self.terraform_path, 'terraform.tfstate'), 'w') as tf_state:
+            tf_state.write('{}')
+        fingerprint.save_fingerprint(self.terraform_path, inputs)
+        self.assertTrue(fingerprint.is_unchanged(self.terraform_path, inputs))
+        self.assertFalse(fingerprint.is_unchanged(self.terraform_path, 'other'))
+        # The state was changed by something else
+        with open(os.path.join(self.terraform_path, 'terraform.tfstate'), 'w') as tf_state:
+            tf_state.write('{"version": 4}')
+        self.assertFalse(fingerprint.is_unchanged(self.terraform_path, inputs))
+        fingerprint.save_fingerprint(self.terraform_path, inputs)
+        fingerprint.forget_fingerprint(self.terraform_path)
+        self.assertFalse(fingerprint.is_unchanged(self.terraform_path, inputs))
+        fingerprint.forget_fingerprint(self.terraform_path)
+
+    def test_needs_init(self):
+        inputs = fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform')
+        self.assertTrue(fingerprint.needs_init(self.terraform_path, inputs))
+        fingerprint.save_init(self.terraform_path, inputs)
+        self.assertFalse(fingerprint.needs_init(self.terraform_path, inputs))
+        # Other resources do not need an init
+        with open(os.path.join(self.terraform_path, 'main.tf'), 'a') as maintf:
+            maintf.write('resource "null_resource" "test" {\n  count = 1\n}\n')
+        self.assertEqual(fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform'), inputs)
+        # But new modules do, even in subdirectories
+        os.makedirs(os.path.join(self.terraform_path, 'modules', 'host'))
+        with open(os.path.join(self.terraform_path, 'modules', 'host', 'main.tf'), 'w') as maintf:
+            maintf.write('module "disk" {\n  source = "../disk"\n}\n')
+        changed = fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform')
+        self.assertTrue(fingerprint.needs_init(self.terraform_path, changed))
+        # And so does another backend
+        fingerprint.save_init(self.terraform_path, changed)
+        os.symlink('../backend_modules/aws', os.path.join(self.terraform_path, 'modules', 'backend'))
+        self.assertTrue(fingerprint.needs_init(
+            self.terraform_path, fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform')))
+        self.assertNotEqual(fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform', '/tmp/cache'),
+                            fingerprint.get_init_fingerprint(self.terraform_path, '/usr/bin/terraform'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+from terracumber import history
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+
+def write_junit(folder, results):
+    """Write a junit output XML file with a testcase for each (name, status, time)"""
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'TEST-features-history.xml'), 'w') as tfile:
+        tfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        tfile.write('<testsuite failures="0" errors="0" skipped="0" tests="%s" time="1.0" name="History">\n'
+                    % len(results))
+        for name, status, time in results:
+            tfile.write('<testcase classname="History" name="%s" time="%s">\n' % (name, time))
+            if status == 'failed':
+                tfile.write('<failure message="failed %s" type="failed"/>\n' % name)
+            elif status == 'skipped':
+                tfile.write('<skipped/>\n')
+            tfile.write('</testcase>\n')
+        tfile.write('</testsuite>\n')
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        write_junit(os.path.join(self.outputdir, '9', 'results_junit'),
+                    [('A', 'passed', 1.0), ('B', 'passed', 5.0), ('C', 'failed', 2.0)])
+        write_junit(os.path.join(self.outputdir, '10', 'results_junit'),
+                    [('A', 'failed', 1.5), ('B', 'passed', 6.0), ('D', 'skipped', 0.0)])
+        write_junit(os.path.join(self.outputdir, '11', 'results_junit'),
+                    [('A', 'failed', 1.2), ('C', 'passed', 9.0), ('D', 'passed', 3.0)])
+        # Builds without results are ignored
+        os.makedirs(os.path.join(self.outputdir, '12'))
+        self.history = history.History(os.path.join(self.outputdir, 'history.sqlite'))
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.outputdir)
+
+    def test_build_sort_key(self):
+        self.assertListEqual(sorted(['10', '9', '2023-01-02-00-00-00', '2023-01-01-00-00-00'],
+                                    key=history.build_sort_key),
+                             ['9', '10', '2023-01-01-00-00-00', '2023-01-02-00-00-00'])
+
+    def test_ingest(self):
+        self.assertListEqual(self.history.ingest(self.outputdir), ['9', '10', '11'])
+        self.assertListEqual(self.history.get_builds(), ['9', '10', '11'])
+        # Only new builds are read
+        write_junit(os.path.join(self.outputdir, '13', 'results_junit'), [('A', 'passed', 1.0)])
+        with patch('terracumber.history.Junit', wraps=history.Junit) as mock_junit:
+            self.assertListEqual(self.history.ingest(self.outputdir), ['13'])
+            mock_junit.assert_called_once_with(os.path.join(self.outputdir, '13', 'results_junit'),
+                                               cache=os.path.join(self.outputdir, '13', 'junit_cache.sqlite'))
+        # Unless they are refreshed
+        self.assertListEqual(self.history.ingest(self.outputdir, refresh=['11']), ['11'])
+        self.assertListEqual(self.history.get_builds(), ['9', '10', '11', '13'])
+
+    def test_ingest_only_new(self):
+        # Nothing with an empty database
+        self.assertListEqual(self.history.ingest(self.outputdir, refresh=['11'], only_new=True), [])
+        self.history.ingest_build('10', os.path.join(self.outputdir, '10', 'results_junit'))
+        write_junit(os.path.join(self.outputdir, '13', 'results_junit'), [('A', 'passed', 1.0)])
+        # Not the builds before the last ingested
+        with patch('terracumber.history.Junit', wraps=history.Junit) as mock_junit:
+            self.assertListEqual(self.history.ingest(self.outputdir, refresh=['10'], only_new=True),
+                                 ['10', '11', '13'])
+            self.assertEqual(mock_junit.call_count, 3)
+        self.assertListEqual(self.history.get_builds(), ['10', '11', '13'])
+
+    def test_ingest_malformed(self):
+        os.makedirs(os.path.join(self.outputdir, '10a', 'results_junit'))
+        with open(os.path.join(self.outputdir, '10a', 'results_junit', 'truncated.xml'), 'w') as junit_file:
+            junit_file.write('<testsuite name="Truncated" failures="0" errors="0" skipped="0" tests="1"')
+        logger = MagicMock()
+        self.history.close()
+        self.history = history.History(os.path.join(self.outputdir, 'history.sqlite'), logger)
+        # The malformed build is skipped, not the later ones
+        self.assertListEqual(self.history.ingest(self.outputdir), ['9', '10', '11'])
+        self.assertIn('10a', logger.warning.call_args.args)
+        # And tried again
+        self.assertListEqual(self.history.ingest(self.outputdir), [])
+        self.assertEqual(logger.warning.call_count, 2)
+
+    def test_ingest_fixture(self):
+        shutil.copytree('test/resources/junit/failures',
+                        os.path.join(self.outputdir, '14', 'results_junit'))
+        self.history.ingest(self.outputdir)
+        self.assertEqual(len(self.history.slowest_tests('14', number=100)), 66)
+        self.assertListEqual(
+            self.history.last_results(
+                'Be able to register a CentOS 7 traditional client and do some basic operations on it',
+                'Schedule some actions on the CentOS 7 traditional client'),
+            [('14', 'failed', 597.027123)])
+
+    def test_last_results(self):
+        self.history.ingest(self.outputdir)
+        self.assertListEqual(self.history.last_results('History', 'A'),
+                             [('11', 'failed', 1.2), ('10', 'failed', 1.5), ('9', 'passed', 1.0)])
+        self.assertListEqual(self.history.last_results('History', 'A', number=1),
+                             [('11', 'failed', 1.2)])
+        self.assertListEqual(self.history.last_results('History', 'Z'), [])
+
+    def test_flipped_tests(self):
+        self.history.ingest(self.outputdir)
+        self.assertListEqual(self.history.flipped_tests(),
+                             [('History', 'C', 'failed', 'passed'), ('History', 'D', 'skipped', 'passed')])
+        self.assertListEqual(self.history.flipped_tests('10'), [('History', 'A', 'passed', 'failed')])
+        self.assertListEqual(self.history.flipped_tests('9'), [])
+
+    def test_slowest_tests(self):
+        self.history.ingest(self.outputdir)
+        self.assertListEqual(self.history.slowest_tests(number=2),
+                             [('History', 'C', 9.0), ('History', 'D', 3.0)])
+        self.assertListEqual(self.history.slowest_tests('9', number=1), [('History', 'B', 5.0)])
+
+    def test_update_baseline(self):
+        self.assertEqual(history.update_baseline(None, 0, 10.0), 10.0)
+        self.assertAlmostEqual(history.update_baseline(10.0, 1, 20.0), 12.0)
+
+    def test_slow_tests(self):
+        for build in range(20, 24):
+            write_junit(os.path.join(self.outputdir, str(build), 'results_junit'),
+                        [('E', 'passed', 20.0), ('F', 'passed', 1.0), ('G', 'failed', 100.0)])
+        write_junit(os.path.join(self.outputdir, '24', 'results_junit'),
+                    [('E', 'passed', 50.0), ('F', 'passed', 5.0), ('G', 'passed', 100.0)])
+        self.history.ingest(self.outputdir)
+        # F is not slower enough in seconds, G has no baseline from passed results
+        self.assertListEqual(self.history.slow_tests(), [('History', 'E', 50.0, 20.0)])
+        self.assertListEqual(self.history.slow_tests(min_seconds=0),
+                             [('History', 'E', 50.0, 20.0), ('History', 'F', 5.0, 1.0)])
+        self.assertListEqual(self.history.slow_tests('23'), [])
+        # The baselines do not change when a build is ingested again
+        self.history.ingest(self.outputdir, refresh=['23', '24'])
+        self.assertListEqual(self.history.slow_tests(), [('History', 'E', 50.0, 20.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
 from terracumber import junit
 from math import isclose
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+from unittest.mock import patch
 
 
 
@@ -38,6 +43,149 @@ class TestJunit(unittest.TestCase):
         self.assertListEqual(self.junit.get_failures(), failure_messages)
         self.assertListEqual(self.junit.get_failures(number=1), failure_messages[0:1])
         self.assertListEqual(self.junit.get_failures(number=0), [])
+        self.assertListEqual(self.junit.get_failures(number=-2), [])
+
+    def test_parse_once(self):
+        with patch('terracumber.junit.parse_file', wraps=junit.parse_file) as mock_parse_file:
+            self.junit.get_totals()
+            self.junit.get_failures()
+            self.junit.get_failures_saltshaker(1)
+            self.assertEqual(mock_parse_file.call_count, 7)
+
+    def test_parse_file(self):
+        summary = junit.parse_file('test/resources/junit/failures/TEST-features-secondary-trad_centos_client.xml')
+        self.assertDictEqual(summary['totals'], {'failures': 3, 'errors': 0, 'skipped': 0, 'tests': 11,
+                                                 'time': 1013.710991})
+        self.assertEqual(len(summary['failures']), 3)
+        self.assertEqual(summary['failures_saltshaker'][0],
+                         'Be able to register a CentOS 7 traditional client and do some basic operations on it::'
+                         'Schedule some actions on the CentOS 7 traditional client')
+        self.assertEqual(len(summary['testcases']), 11)
+        self.assertListEqual(summary['testcases'][0],
+                             ['Be able to register a CentOS 7 traditional client and do some basic operations on it',
+                              'Delete the CentOS minion before traditional client tests', 3.599014, 'passed'])
+        self.assertEqual([testcase[3] for testcase in summary['testcases']].count('failed'), 3)
+
+    def test_parse_file_without_classname(self):
+        summary = junit.parse_file('test/resources/junit/no-classname/TEST-pytest.xml')
+        self.assertListEqual(summary['failures'], ['assert False'])
+        self.assertListEqual(summary['failures_saltshaker'], ['::test_without_classname'])
+        self.assertListEqual(summary['testcases'], [['', 'test_without_classname', 1.0, 'failed'],
+                                                    ['tests.test_module', 'test_with_classname', 0.5, 'passed']])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = os.path.join(tmpdir, 'results_junit')
+            shutil.copytree('test/resources/junit/failures', results)
+            cache = os.path.join(tmpdir, 'junit_cache.sqlite')
+            totals = junit.Junit(results, cache=cache).get_totals()
+            # Nothing is parsed again by a new object
+            with patch('terracumber.junit.parse_file', wraps=junit.parse_file) as mock_parse_file:
+                self.assertDictEqual(junit.Junit(results, cache=cache).get_totals(), totals)
+                mock_parse_file.assert_not_called()
+            # Only the new or replaced files are parsed
+            shutil.copy('test/resources/junit/passed/TEST-features-secondary-srv_users.xml',
+                        os.path.join(results, 'TEST-features-secondary-trad_centos_client.xml'))
+            shutil.copy('test/resources/junit/passed/TEST-features-secondary-srv_users.xml',
+                        os.path.join(results, 'TEST-rerun.xml'))
+            totals = junit.Junit(results).get_totals()
+            with patch('terracumber.junit.parse_file', wraps=junit.parse_file) as mock_parse_file:
+                self.assertDictEqual(junit.Junit(results, cache=cache).get_totals(), totals)
+                self.assertEqual(mock_parse_file.call_count, 2)
+            self.assertListEqual(junit.Junit(results, cache=cache).get_failures(), [])
+
+    def test_close(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = os.path.join(tmpdir, 'results_junit')
+            shutil.copytree('test/resources/junit/failures', results)
+            cache = os.path.join(tmpdir, 'junit_cache.sqlite')
+            with junit.Junit(results, cache=cache) as results_junit:
+                totals = results_junit.get_totals()
+                junit_cache = results_junit.cache
+            self.assertIsNone(results_junit.cache)
+            with self.assertRaises(sqlite3.ProgrammingError):
+                junit_cache.commit()
+            # Opened again if needed
+            self.assertListEqual(results_junit.get_failures(), junit.Junit(results).get_failures())
+            results_junit.close()
+            # Without cache
+            with junit.Junit(results) as results_junit:
+                self.assertDictEqual(results_junit.get_totals(), totals)
+
+    def test_parallel(self):
+        serial = junit.Junit('test/resources/junit/failures', processes=1)
+        parallel = junit.Junit('test/resources/junit/failures', processes=2, parallel_threshold=2)
+        self.assertDictEqual(parallel.get_totals(), serial.get_totals())
+        self.assertListEqual(parallel.get_failures(), serial.get_failures())
+        self.assertListEqual(parallel.get_failures_saltshaker(), serial.get_failures_saltshaker())
+
+    def test_early_exit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copytree('test/resources/junit/failures', tmpdir, dirs_exist_ok=True)
+            for mtime, tfile in enumerate(sorted(os.listdir(tmpdir), reverse=True)):
+                os.utime(os.path.join(tmpdir, tfile), (mtime, mtime))
+            # The file with failures is the first one by mtime
+            self.junit = junit.Junit(tmpdir)
+            with patch('terracumber.junit.iterparse_file', wraps=junit.iterparse_file) as mock_iterparse_file:
+                self.assertTrue(self.junit.has_failures())
+                self.assertEqual(self.junit.get_failures_saltshaker(1), [
+                    'Be able to register a CentOS 7 traditional client and do some basic operations on it::'
+                    'Schedule some actions on the CentOS 7 traditional client'])
+                self.assertEqual(mock_iterparse_file.call_count, 2)
+                mock_iterparse_file.assert_called_with(
+                    os.path.join(tmpdir, 'TEST-features-secondary-trad_centos_client.xml'))
+                # The file was not read completely, so it is not kept
+                self.assertDictEqual(self.junit.parsed, {})
+                self.assertEqual(len(self.junit.get_failures()), 3)
+                self.assertEqual(len(self.junit.parsed), 7)
+                self.assertEqual(len(self.junit.get_failures(2)), 2)
+                self.assertEqual(mock_iterparse_file.call_count, 9)
+
+    def test_cache_not_created_without_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = os.path.join(tmpdir, 'junit_cache.sqlite')
+            self.assertIsNone(junit.Junit(os.path.join(tmpdir, 'results_junit'), cache=cache).get_totals())
+            self.assertFalse(os.path.exists(cache))
+
+    def test_merge_reruns(self):
+        classname = 'Be able to register a CentOS 7 traditional client and do some basic operations on it'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = os.path.join(tmpdir, 'results_junit')
+            shutil.copytree('test/resources/junit/failures', results)
+            rerun = os.path.join(results, 'TEST-features-rerun.xml')
+            with open(rerun, 'w') as tfile:
+                tfile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                            '<testsuite failures="1" errors="0" skipped="0" tests="2" time="30.0" name="%s">\n'
+                            '<testcase classname="%s" name="Schedule some actions on the CentOS 7 traditional client"'
+                            ' time="10.0"/>\n'
+                            '<testcase classname="%s" name="Cleanup: bootstrap a CentOS minion after traditional'
+                            ' client tests" time="20.0">\n'
+                            '<failure message="failed again" type="failed"/>\n</testcase>\n</testsuite>\n'
+                            % (classname, classname, classname))
+            newest = max(os.path.getmtime(os.path.join(results, tfile)) for tfile in os.listdir(results))
+            os.utime(rerun, (newest + 10, newest + 10))
+            # Without merging, the reruns are counted twice
+            self.assertEqual(junit.Junit(results).get_totals()['tests'], 68)
+            merged = junit.Junit(results, merge_reruns=True)
+            totals = merged.get_totals()
+            time = sum(testcase[2] for testcase in junit.Junit('test/resources/junit/failures').get_testcases())
+            self.assertTrue(isclose(totals['time'], time - 597.027123 + 10.0 - 253.802312 + 20.0))
+            del totals['time']
+            self.assertDictEqual(totals, {'failures': 2, 'errors': 0, 'skipped': 0, 'passed': 64, 'tests': 66})
+            self.assertListEqual(merged.get_failures(),
+                                 ['failed again',
+                                  'failed Cleanup: re-subscribe the new CentOS minion to a base channel'])
+            self.assertListEqual(merged.get_failures_saltshaker(number=1),
+                                 ['%s::Cleanup: bootstrap a CentOS minion after traditional client tests' % classname])
+            self.assertListEqual(merged.get_recovered(),
+                                 ['%s::Schedule some actions on the CentOS 7 traditional client' % classname])
+            self.assertTrue(merged.has_failures())
+
+    def test_merge_reruns_no_files(self):
+        merged = junit.Junit('test/resources/junit/missing', merge_reruns=True)
+        self.assertIsNone(merged.get_totals())
+        self.assertListEqual(merged.get_failures(), [])
+        self.assertListEqual(merged.get_recovered(), [])
 
 
 class TestJunitSaltShaker(unittest.TestCase):
@@ -52,6 +200,7 @@ class TestJunitSaltShaker(unittest.TestCase):
         self.assertListEqual(self.junit.get_failures_saltshaker(), failure_messages)
         self.assertListEqual(self.junit.get_failures_saltshaker(number=1), failure_messages[0:1])
         self.assertListEqual(self.junit.get_failures_saltshaker(number=0), [])
+        self.assertListEqual(self.junit.get_failures_saltshaker(number=-2), [])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+from terracumber import orchestrator
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+# Fake terraform binary, failing apply when FAKE_TERRAFORM_FAIL is set
+FAKE_TERRAFORM = '''#!/bin/sh
+echo "terraform $1 at $(pwd)"
+if [ "$1" = "apply" ] && [ -n "$FAKE_TERRAFORM_FAIL" ]; then
+  echo "Error: $FAKE_TERRAFORM_FAIL"
+  exit 1
+fi
+'''
+
+
+class TestOrchestrator(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logdir = os.path.join(self.tmpdir, 'logs')
+        self.terraform_bin = os.path.join(self.tmpdir, 'terraform')
+        with open(self.terraform_bin, 'w') as terraform_bin:
+            terraform_bin.write(FAKE_TERRAFORM)
+        os.chmod(self.terraform_bin, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_environment(self, name, **kwargs):
+        terraform_path = os.path.join(self.tmpdir, name)
+        os.makedirs(terraform_path, exist_ok=True)
+        environment = {'name': name, 'maintf': 'test/resources/test.tf', 'terraform_path': terraform_path}
+        environment.update(kwargs)
+        return environment
+
+    def write_environments(self, environments):
+        filename = os.path.join(self.tmpdir, 'environments.json')
+        with open(filename, 'w') as environments_file:
+            json.dump(environments, environments_file)
+        return filename
+
+    def test_load_environments(self):
+        environments = orchestrator.load_environments(self.write_environments(
+            [self.get_environment('a'), self.get_environment('b', backend='aws', parallelism=5)]))
+        self.assertListEqual([environment['name'] for environment in environments], ['a', 'b'])
+        self.assertEqual(environments[0]['backend'], 'libvirt')
+        self.assertEqual(environments[0]['parallelism'], 10)
+        self.assertEqual(environments[1]['backend'], 'aws')
+        self.assertEqual(environments[1]['parallelism'], 5)
+
+    def test_load_environments_invalid(self):
+        for definitions in [{'name': 'a'},
+                            [{'name': 'a', 'maintf': 'main.tf'}],
+                            [self.get_environment('a', unknown=True)],
+                            [self.get_environment('a'), self.get_environment('a')],
+                            [self.get_environment('a'), dict(self.get_environment('a'), name='b')]]:
+            with self.assertRaises(ValueError):
+                orchestrator.load_environments(self.write_environments(definitions))
+
+    def test_run(self):
+        environments = orchestrator.load_environments(self.write_environments(
+            [self.get_environment('a'),
+             self.get_environment('b', variables={'FAKE_TERRAFORM_FAIL': 'boom'}),
+             self.get_environment('c')]))
+        results = orchestrator.Orchestrator(environments, self.logdir, 2, self.terraform_bin).run()
+        self.assertListEqual([(result['name'], result['status'], result['step']) for result in results],
+                             [('a', 'passed', None), ('b', 'failed', 'apply'), ('c', 'passed', None)])
+        self.assertEqual(results[1]['message'], 'Error: boom')
+        # Each environment has its own log
+        for name in ['a', 'b', 'c']:
+            with open(os.path.join(self.logdir, '%s.log' % name)) as logfile:
+                self.assertListEqual(logfile.read().splitlines()[:2],
+                                     ['terraform init at %s' % os.path.join(self.tmpdir, name),
+                                      'terraform apply at %s' % os.path.join(self.tmpdir, name)])
+        # The next run does not need terraform init
+        results = orchestrator.Orchestrator(environments[:1], self.logdir, 2, self.terraform_bin).run()
+        self.assertEqual(results[0]['status'], 'passed')
+        with open(os.path.join(self.logdir, 'a.log')) as logfile:
+            self.assertIn('Nothing changed since the last terraform init, skipping it', logfile.read())
+
+    def test_run_error(self):
+        environments = orchestrator.load_environments(self.write_environments(
+            [self.get_environment('a', maintf='test/resources/missing.tf'), self.get_environment('b')]))
+        results = orchestrator.Orchestrator(environments, self.logdir, 2, self.terraform_bin).run()
+        self.assertEqual(results[0]['status'], 'error')
+        self.assertEqual(results[0]['step'], 'init')
+        self.assertTrue(results[0]['message'].startswith('FileNotFoundError'))
+        self.assertEqual(results[1]['status'], 'passed')
+
+    def test_max_parallel(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def run_environment(environment):
+            with lock:
+                running.append(environment['name'])
+                max_running.append(len(running))
+            barrier.wait()
+            with lock:
+                running.remove(environment['name'])
+            return {'name': environment['name']}
+
+        environments = [{'name': name} for name in 'abcd']
+        with patch.object(orchestrator.Orchestrator, 'run_environment', side_effect=run_environment):
+            results = orchestrator.Orchestrator(environments, self.logdir, 2, self.terraform_bin).run()
+        self.assertListEqual([result['name'] for result in results], ['a', 'b', 'c', 'd'])
+        self.assertEqual(max(max_running), 2)
+
+    def test_format_summary(self):
+        results = [{'name': 'a', 'status': 'passed', 'step': None, 'message': '', 'time': 61.2,
+                    'logfile': '/tmp/a.log'},
+                   {'name': 'b', 'status': 'failed', 'step': 'apply', 'message': 'Error: boom', 'time': 5,
+                    'logfile': '/tmp/b.log'}]
+        self.assertEqual(orchestrator.format_summary(results),
+                         'a: PASSED in 61s, log at /tmp/a.log\n'
+                         'b: FAILED in 5s at apply (Error: boom), log at /tmp/b.log\n'
+                         '1 of 2 environments passed')
+
+
+if __name__ == '__main__':
+    unittest.main()
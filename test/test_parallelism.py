@@ -0,0 +1,106 @@
+from terracumber import parallelism
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestParallelism(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.tmpdir, 'cache', 'parallelism.json')
+        self.advisor = parallelism.ParallelismAdvisor('libvirt', 40, self.history_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def choose(self, load=0.5, cpus=8):
+        return self.advisor.choose(load=load, cpus=cpus)[0]
+
+    def record(self, value, seconds, result=0):
+        self.advisor.record(value, seconds, result, load=0.5, cpus=8)
+
+    def test_get_resources_bucket(self):
+        self.assertListEqual([parallelism.get_resources_bucket(resources) for resources in [0, 1, 2, 3, 40, 64, 65]],
+                             [0, 1, 2, 4, 64, 64, 128])
+
+    def test_record(self):
+        self.record(6, 100.5)
+        with open(self.history_file) as history_file:
+            history = json.load(history_file)
+        self.assertListEqual(list(history['applies']), ['libvirt:64'])
+        record = history['applies']['libvirt:64'][0]
+        self.assertEqual((record['parallelism'], record['seconds'], record['result'], record['resources']),
+                         (6, 100.5, 0, 40))
+        for _ in range(parallelism.MAX_RECORDS + 5):
+            self.record(6, 100)
+        self.assertEqual(len(self.advisor.get_records()), parallelism.MAX_RECORDS)
+        # Other number of resources
+        self.assertListEqual(parallelism.ParallelismAdvisor('libvirt', 100, self.history_file).get_records(), [])
+
+    def test_record_resources(self):
+        terraform_path = os.path.join(self.tmpdir, 'sumaform')
+        advisor = parallelism.ParallelismAdvisor('libvirt', 0, self.history_file, terraform_path)
+        self.assertEqual(advisor.get_key(), 'libvirt:0')
+        # Recorded with the number of resources after the apply
+        advisor.record(6, 100, 0, 40, load=0.5, cpus=8)
+        self.assertEqual(advisor.get_key(), 'libvirt:64')
+        with open(self.history_file) as history_file:
+            history = json.load(history_file)
+        self.assertListEqual(list(history['applies']), ['libvirt:64'])
+        self.assertDictEqual(history['resources'], {terraform_path: 40})
+        # An empty state (destroyed environment) uses the size of the last successful apply
+        advisor = parallelism.ParallelismAdvisor('libvirt', 0, self.history_file, terraform_path)
+        self.assertEqual(advisor.get_key(), 'libvirt:64')
+        self.assertEqual(len(advisor.get_records()), 1)
+        # Failed applies do not change it
+        advisor.record(8, 50, 1, 2, load=0.5, cpus=8)
+        self.assertEqual(parallelism.ParallelismAdvisor('libvirt', 0, self.history_file,
+                                                        terraform_path).get_last_resources(), 40)
+        # Other terraform path
+        self.assertEqual(parallelism.ParallelismAdvisor('libvirt', 0, self.history_file,
+                                                        self.tmpdir).get_key(), 'libvirt:0')
+
+    def test_choose_default(self):
+        self.assertEqual(self.choose(), 6)
+        self.assertEqual(parallelism.ParallelismAdvisor('aws', 40, self.history_file).choose(0.5, 8)[0], 10)
+        self.assertEqual(parallelism.ParallelismAdvisor('other', 40, self.history_file).choose(0.5, 8)[0], 10)
+        # Corrupted history
+        os.makedirs(os.path.dirname(self.history_file))
+        with open(self.history_file, 'w') as history_file:
+            history_file.write('[')
+        self.assertEqual(self.choose(), 6)
+
+    def test_choose_converges(self):
+        # Faster with a higher parallelism, up to 8
+        durations = {1: 800, 2: 500, 4: 300, 6: 200, 8: 150, 10: 180}
+        chosen = []
+        for _ in range(6):
+            chosen.append(self.choose())
+            self.record(chosen[-1], durations[chosen[-1]])
+        self.assertListEqual(chosen, [6, 8, 10, 8, 8, 8])
+        # The maximum for libvirt is never exceeded
+        self.record(10, 10)
+        self.assertEqual(self.choose(), 10)
+
+    def test_choose_failures(self):
+        self.record(6, 50, result=1)
+        self.assertEqual(self.choose(), 4)
+        self.record(4, 200)
+        # 6 failed, so only 2 is tried
+        self.assertEqual(self.choose(), 2)
+        self.record(2, 300)
+        self.assertEqual(self.choose(), 4)
+
+    def test_choose_load(self):
+        self.assertEqual(self.choose(load=8, cpus=8), 6)
+        self.assertEqual(self.choose(load=12, cpus=8), 4)
+        self.assertEqual(self.choose(load=20, cpus=8), 2)
+        self.assertEqual(self.choose(load=1000, cpus=8), 1)
+        value, reason = self.advisor.choose(load=12, cpus=8)
+        self.assertIn('overloaded', reason)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
-from terracumber import terraformer
+from terracumber import parallelism, terraformer, tfstate
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from subprocess import CalledProcessError
 from unittest.mock import patch
@@ -35,6 +39,19 @@ class TestTerraformer(unittest.TestCase):
             self.assertIsNone(self.terraformer.get_hostname('controller'))
 
     def test_get_resources(self, mock_unlink, mock_symlink, mock_path, mock_copy):
+        self.terraformer = terraformer.Terraformer(self.terraform_path, self.maintf, self.backend)
+        with open('test/resources/terraform.tfstate.list') as addresses:
+            all_resources = addresses.read().splitlines()
+        with patch.object(self.terraformer, '_Terraformer__run_command') as mock_run_command:
+            self.assertListEqual(self.terraformer._Terraformer__get_resources(), all_resources)
+            self.assertListEqual(self.terraformer._Terraformer__get_resources('.*(domain|main_disk).*'),
+                                 [resource for resource in all_resources
+                                  if 'domain' in resource or 'main_disk' in resource])
+            self.assertFalse(self.terraformer._Terraformer__get_resources('.*invalid.*'))
+            mock_run_command.assert_not_called()
+
+    @patch('terracumber.terraformer.list_addresses', side_effect=ValueError)
+    def test_get_resources_state_list(self, mock_list_addresses, mock_unlink, mock_symlink, mock_path, mock_copy):
         self.terraformer = terraformer.Terraformer(self.terraform_path, self.maintf, self.backend)
         with patch.object(self.terraformer, '_Terraformer__run_command') as mock_run_command:
             mock_run_command.return_value = ['module.base.module.base_backend.libvirt_network.additional_network[0]',
@@ -71,6 +88,7 @@ class TestTerraformer(unittest.TestCase):
             mock_open.assert_called_once_with('test/resources/output.log', 'a')
             mock_open.return_value.write.assert_called_once_with('TEST')
             mock_open.return_value.close.assert_called_once()
+            self.assertListEqual(self.terraformer.output_tail.get_lines(), ['TEST'])
             # Test return values
             mock_cmd_iterator.return_value = iter(["TEST"])
             mock_open.reset_mock()
@@ -109,6 +127,30 @@ class TestTerraformer(unittest.TestCase):
             # Assert
             mock_run_command.assert_called_with(["/usr/bin/terraform", "apply", "-auto-approve", "-parallelism=20"])
 
+    def test_taint_replace(self, mock_unlink, mock_symlink, mock_path, mock_copy):
+        self.terraformer = terraformer.Terraformer(self.terraform_path, self.maintf, self.backend, None,
+                                                   self.output_file)
+        resources = ['module.server.module.server.module.host.data.template_file.user_data',
+                     'module.server.module.server.module.host.libvirt_domain.domain[0]',
+                     'module.minion["data"].libvirt_volume.main_disk[0]']
+        with patch.object(self.terraformer, '_Terraformer__get_resources', return_value=resources), \
+                patch.object(self.terraformer, '_Terraformer__run_command') as mock_run_command:
+            self.terraformer.taint('.*', replace=True)
+            mock_run_command.assert_not_called()
+            self.terraformer.apply(20)
+            mock_run_command.assert_called_once_with(
+                ["/usr/bin/terraform", "apply", "-auto-approve", "-parallelism=20",
+                 "-replace=module.server.module.server.module.host.libvirt_domain.domain[0]",
+                 '-replace=module.minion["data"].libvirt_volume.main_disk[0]'])
+            # Only the next apply replaces the resources
+            self.terraformer.apply(20)
+            mock_run_command.assert_called_with(["/usr/bin/terraform", "apply", "-auto-approve", "-parallelism=20"])
+            # Without replace, each resource is tainted
+            mock_run_command.reset_mock()
+            self.terraformer.taint('.*')
+            self.assertEqual(mock_run_command.call_count, 3)
+            mock_run_command.assert_called_with(["/usr/bin/terraform", "taint", resources[2]])
+
 @patch('terracumber.terraformer.copy')
 @patch('terracumber.terraformer.path')
 @patch('terracumber.terraformer.symlink')
@@ -128,5 +170,166 @@ class TestTerraformerSaltShaker(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             self.assertIsNone(self.terraformer.get_single_node_ipaddr())
 
+class TestTerraformerUnchangedInputs(unittest.TestCase):
+    def setUp(self):
+        self.terraform_path = tempfile.mkdtemp()
+        self.terraformer = terraformer.Terraformer(self.terraform_path, 'test/resources/test.tf', 'libvirt',
+                                                   output_file='test/resources/output.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.terraform_path)
+
+    def apply(self, unchanged_inputs, results):
+        """Run apply with the results for each terraform command, returning the commands"""
+        with patch.object(self.terraformer, '_Terraformer__run_command', side_effect=results) as mock_run_command:
+            self.assertEqual(self.terraformer.apply(unchanged_inputs=unchanged_inputs), (results or [0])[-1])
+            return [call.args[0][:2] + call.args[0][-1:] for call in mock_run_command.call_args_list]
+
+    def test_apply_first_run(self):
+        self.assertListEqual(self.apply('skip', [0]),
+                             [['/usr/bin/terraform', 'apply', '-parallelism=10']])
+        self.assertListEqual(self.apply('skip', []), [])
+
+    def test_apply_plan(self):
+        self.apply('apply', [0])
+        # No changes
+        self.assertListEqual(self.apply('plan', [0]),
+                             [['/usr/bin/terraform', 'plan', '-parallelism=10']])
+        # Changes, the saved plan is applied
+        self.assertListEqual(self.apply('plan', [2, 0]),
+                             [['/usr/bin/terraform', 'plan', '-parallelism=10'],
+                              ['/usr/bin/terraform', 'apply', terraformer.PLAN_FILE]])
+        # A failed apply is never skipped
+        self.apply('apply', [1])
+        self.assertListEqual(self.apply('skip', [0]),
+                             [['/usr/bin/terraform', 'apply', '-parallelism=10']])
+
+    def test_init(self):
+        plugin_cache_dir = os.path.join(self.terraform_path, 'plugin-cache')
+        self.terraformer.plugin_cache_dir = plugin_cache_dir
+        with patch.object(self.terraformer, '_Terraformer__run_command', return_value=0) as mock_run_command, \
+                patch('terracumber.terraformer.FileLock') as mock_file_lock:
+            self.assertEqual(self.terraformer.init(force=False), 0)
+            mock_run_command.assert_called_once_with(['/usr/bin/terraform', 'init'])
+            mock_file_lock.assert_called_once_with(plugin_cache_dir + '/.terracumber.lock')
+            self.assertTrue(os.path.isdir(plugin_cache_dir))
+            # Nothing changed
+            self.assertEqual(self.terraformer.init(force=False), 0)
+            self.assertEqual(mock_run_command.call_count, 1)
+            self.terraformer.init()
+            self.assertEqual(mock_run_command.call_count, 2)
+            # New lock file
+            with open(os.path.join(self.terraform_path, '.terraform.lock.hcl'), 'w') as lock_file:
+                lock_file.write('provider "registry.terraform.io/dmacvicar/libvirt" {}\n')
+            self.terraformer.init(force=False)
+            self.assertEqual(mock_run_command.call_count, 3)
+
+    @patch('terracumber.terraformer.Popen')
+    def test_plugin_cache_dir(self, mock_popen):
+        mock_popen.return_value.stdout.readline.return_value = ''
+        mock_popen.return_value.wait.return_value = 0
+        self.terraformer.plugin_cache_dir = '/tmp/plugin-cache'
+        self.terraformer.destroy()
+        self.assertEqual(mock_popen.call_args.kwargs['env']['TF_PLUGIN_CACHE_DIR'], '/tmp/plugin-cache')
+
+    def test_apply_changed_inputs(self):
+        self.apply('apply', [0])
+        self.terraformer.variables = {'CUCUMBER_BRANCH': 'test'}
+        self.assertListEqual(self.apply('skip', [0]),
+                             [['/usr/bin/terraform', 'apply', '-parallelism=10']])
+        self.assertListEqual(self.apply('skip', []), [])
+        # Resources to be replaced
+        self.terraformer.replace = ['libvirt_domain.domain[0]']
+        self.assertListEqual(self.apply('skip', [0]),
+                             [['/usr/bin/terraform', 'apply', '-replace=libvirt_domain.domain[0]']])
+
+
+class TestTerraformerTimeline(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.terraform_path = os.path.join(self.tmpdir, 'sumaform')
+        os.makedirs(self.terraform_path)
+        # Fake terraform binary, printing the events of a failed apply with -json
+        terraform_bin = os.path.join(self.tmpdir, 'terraform')
+        with open(terraform_bin, 'w') as fake_terraform:
+            fake_terraform.write('#!/bin/sh\necho "$@" > %s/arguments\ncat %s\nexit 1\n' %
+                                 (self.tmpdir, os.path.abspath('test/resources/terraform_apply.json')))
+        os.chmod(terraform_bin, 0o755)
+        self.output_file = os.path.join(self.tmpdir, 'sumaform.log')
+        self.terraformer = terraformer.Terraformer(self.terraform_path, 'test/resources/test.tf', 'libvirt',
+                                                   output_file=self.output_file, terraform_bin=terraform_bin,
+                                                   quiet=True, timeline=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_apply_timeline(self):
+        self.assertEqual(self.terraformer.apply(), 1)
+        with open(os.path.join(self.tmpdir, 'arguments')) as arguments:
+            self.assertEqual(arguments.read(), 'apply -json -auto-approve -parallelism=10\n')
+        self.assertEqual(self.terraformer.get_timeline_file(), os.path.join(self.tmpdir, 'sumaform.timeline.json'))
+        with open(self.terraformer.get_timeline_file()) as timeline_file:
+            self.assertEqual(len(json.load(timeline_file)), 3)
+        # The log has the human readable messages
+        with open(self.output_file) as output_file:
+            lines = output_file.read().splitlines()
+        self.assertEqual(lines[0], 'Terraform 1.5.7')
+        self.assertEqual(lines[-1], 'The image was removed while the domain was being created.')
+        self.assertEqual(self.terraformer.output_tail.get_lines()[-1],
+                         'The image was removed while the domain was being created.')
+
+
+@patch('terracumber.parallelism.cpu_count', return_value=8)
+@patch('terracumber.parallelism.getloadavg', return_value=(0.5, 0.5, 0.5))
+class TestTerraformerAutoParallelism(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.terraform_path = os.path.join(self.tmpdir, 'sumaform')
+        os.makedirs(self.terraform_path)
+        # Fake terraform binary, keeping the arguments of each call and creating the state on apply
+        terraform_bin = os.path.join(self.tmpdir, 'terraform')
+        with open(terraform_bin, 'w') as fake_terraform:
+            fake_terraform.write('#!/bin/sh\necho "$@" >> %s/arguments\n'
+                                 '[ "$1" = apply ] && cp %s terraform.tfstate\nexit 0\n'
+                                 % (self.tmpdir, os.path.abspath('test/resources/terraform.tfstate')))
+        os.chmod(terraform_bin, 0o755)
+        self.history_file = os.path.join(self.tmpdir, 'parallelism.json')
+        self.terraformer = terraformer.Terraformer(self.terraform_path, 'test/resources/test.tf', 'libvirt',
+                                                   output_file=os.path.join(self.tmpdir, 'sumaform.log'),
+                                                   terraform_bin=terraform_bin, quiet=True,
+                                                   parallelism_history=self.history_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_applies(self):
+        with open(self.history_file) as history_file:
+            return json.load(history_file)['applies']
+
+    def test_apply_auto(self, mock_getloadavg, mock_cpu_count):
+        key = 'libvirt:%d' % parallelism.get_resources_bucket(
+            len(tfstate.list_addresses('test/resources/terraform.tfstate')))
+        # Full apply, recorded with the size of the environment after it
+        self.assertEqual(self.terraformer.apply('auto'), 0)
+        self.assertListEqual(list(self.get_applies()), [key])
+        # Apply changing an existing environment, not recorded
+        self.assertEqual(self.terraformer.apply('auto'), 0)
+        self.assertEqual(len(self.get_applies()[key]), 1)
+        # Full apply after destroying it, recorded with the size of the last apply
+        os.remove(os.path.join(self.terraform_path, 'terraform.tfstate'))
+        self.assertEqual(self.terraformer.apply('auto'), 0)
+        with open(os.path.join(self.tmpdir, 'arguments')) as arguments:
+            self.assertListEqual([line.split()[2] for line in arguments],
+                                 ['-parallelism=6', '-parallelism=8', '-parallelism=8'])
+        self.assertListEqual([(record['parallelism'], record['result']) for record in self.get_applies()[key]],
+                             [(6, 0), (8, 0)])
+        with open(os.path.join(self.tmpdir, 'sumaform.log')) as output_file:
+            self.assertIn('Using parallelism 6: no successful applies recorded', output_file.read())
+        # Not recorded when the apply is skipped or only applies a saved plan
+        self.assertEqual(self.terraformer.apply('auto', unchanged_inputs='skip'), 0)
+        self.assertEqual(self.terraformer.apply('auto', unchanged_inputs='plan'), 0)
+        self.assertListEqual(list(self.get_applies()), [key])
+        self.assertEqual(len(self.get_applies()[key]), 2)
+
 if __name__ == '__main__':
     unittest.main()
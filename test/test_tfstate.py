@@ -0,0 +1,99 @@
+from terracumber import tfstate
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+class TestTfState(unittest.TestCase):
+    def setUp(self):
+        self.tfstate = tfstate.TfState('test/resources/terraform.tfstate')
+
+    def test_read_outputs(self):
+        with open('test/resources/terraform.tfstate') as tf_state:
+            expected = json.load(tf_state)['outputs']
+        for read_size in [1, 7, tfstate.READ_SIZE]:
+            self.assertDictEqual(tfstate.read_outputs('test/resources/terraform.tfstate', read_size), expected)
+
+    def test_read_outputs_after_resources(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'terraform.tfstate')
+            with open(filename, 'w') as tf_state:
+                tf_state.write('{"version": 4, "resources": [{"a": "x\\\\\\"}{[", "b": [1, {"outputs": {}}]}], '
+                               '"outputs": {"k": {"value": "v\\\\"}}}, "z": 1}')
+            for read_size in range(1, 20):
+                self.assertDictEqual(tfstate.read_outputs(filename, read_size), {'k': {'value': 'v\\'}})
+            with open(filename, 'w') as tf_state:
+                tf_state.write('{"version": 4, "resources": []}')
+            self.assertIsNone(tfstate.read_outputs(filename))
+
+    def test_list_addresses(self):
+        # Same output as terraform state list
+        with open('test/resources/terraform.tfstate.list') as addresses:
+            self.assertListEqual(tfstate.list_addresses('test/resources/terraform.tfstate'),
+                                 addresses.read().splitlines())
+        self.assertListEqual(tfstate.list_addresses('test/resources/salt-shaker/terraform.tfstate'), [])
+
+    def test_list_addresses_order(self):
+        resources = [
+            {'module': 'module.b["x"]', 'mode': 'managed', 'type': 't', 'name': 'r', 'instances': [{}]},
+            {'module': 'module.b[10]', 'mode': 'managed', 'type': 't', 'name': 'r', 'instances': [{}]},
+            {'module': 'module.b[9]', 'mode': 'managed', 'type': 't', 'name': 'r', 'instances': [{}]},
+            {'module': 'module.a.module.c', 'mode': 'managed', 'type': 't', 'name': 'r', 'instances': [{}]},
+            {'mode': 'managed', 'type': 'u', 'name': 'r',
+             'instances': [{'index_key': 'k"1'}, {'index_key': 2}, {'index_key': 10}]},
+            {'mode': 'managed', 'type': 't', 'name': 'r', 'instances': []},
+            {'mode': 'data', 'type': 'z', 'name': 'r', 'instances': [{}]}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'terraform.tfstate')
+            with open(filename, 'w') as tf_state:
+                json.dump({'version': 4, 'resources': resources}, tf_state)
+            self.assertListEqual(tfstate.list_addresses(filename),
+                                 ['data.z.r', 'u.r[2]', 'u.r[10]', 'u.r["k\\"1"]', 'module.b[9].t.r',
+                                  'module.b[10].t.r', 'module.b["x"].t.r', 'module.a.module.c.t.r'])
+            with open(filename, 'w') as tf_state:
+                json.dump({'version': 3, 'modules': []}, tf_state)
+            with self.assertRaises(ValueError):
+                tfstate.list_addresses(filename)
+
+    def test_get_hostnames(self):
+        self.assertListEqual(self.tfstate.get_hostnames('controller'), ['uyuni-master-ctl.mgr.suse.de'])
+        self.assertListEqual(self.tfstate.get_hostnames('suse-minion'), ['uyuni-master-min-sles15.mgr.suse.de'])
+        self.assertListEqual(self.tfstate.get_hostnames('base'), [])
+        self.assertListEqual(self.tfstate.get_hostnames('invalid'), [])
+
+    def test_get_nodes(self):
+        nodes = self.tfstate.get_nodes()
+        self.assertNotIn('base', nodes)
+        self.assertEqual(len(nodes), 12)
+        self.assertDictEqual(nodes['server'], {'hostnames': ['uyuni-master-srv.mgr.suse.de'], 'ipaddrs': []})
+
+    def test_get_ipaddrs(self):
+        single_node = tfstate.TfState('test/resources/salt-shaker/terraform.tfstate')
+        self.assertListEqual(single_node.get_ipaddrs(), [['192.168.122.100', 'fe80::2e0c:c955:8c17:985d']])
+        self.assertListEqual(single_node.get_hostnames(), ['salt-shaker-products-next-sles15sp5.tf.local'])
+
+    def test_memoized(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'terraform.tfstate')
+            shutil.copy('test/resources/salt-shaker/terraform.tfstate', filename)
+            state = tfstate.get_tfstate(filename)
+            self.assertIs(tfstate.get_tfstate(os.path.join(tmpdir, '.', 'terraform.tfstate')), state)
+            with patch('terracumber.tfstate.read_outputs', wraps=tfstate.read_outputs) as mock_read_outputs:
+                state.get_ipaddrs()
+                state.get_hostnames()
+                self.assertEqual(mock_read_outputs.call_count, 1)
+                # A new file (i.e. written by terraform) is read again
+                os.unlink(filename)
+                shutil.copy('test/resources/terraform.tfstate', filename)
+                self.assertListEqual(state.get_hostnames('controller'), ['uyuni-master-ctl.mgr.suse.de'])
+                self.assertEqual(mock_read_outputs.call_count, 2)
+            os.unlink(filename)
+            with self.assertRaises(FileNotFoundError):
+                state.get_outputs()
+
+
+if __name__ == '__main__':
+    unittest.main()
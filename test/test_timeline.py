@@ -0,0 +1,62 @@
+from terracumber import timeline
+import json
+import os
+import tempfile
+import unittest
+
+DOMAIN = 'module.minion.module.minion.libvirt_domain.domain[0]'
+DISK = 'module.server.module.server.libvirt_volume.main_disk[0]'
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.timeline = timeline.Timeline()
+        with open('test/resources/terraform_apply.json') as events:
+            self.output = [self.timeline.feed(line) for line in events]
+
+    def test_feed(self):
+        self.assertEqual(self.output[0], 'Terraform 1.5.7\n')
+        self.assertEqual(self.output[4], '%s: Creating...\n' % DISK)
+        self.assertEqual(self.output[-1], 'Error: error creating libvirt domain: Cannot access storage file\n\n'
+                                          'The image was removed while the domain was being created.\n')
+        # Not an event
+        self.assertEqual(self.timeline.feed('panic: runtime error\n'), 'panic: runtime error\n')
+        self.assertEqual(self.timeline.feed('[1, 2]\n'), '[1, 2]\n')
+
+    def test_get_operations(self):
+        self.assertListEqual(
+            [(operation['address'], operation['action'], operation['status'], operation['seconds'])
+             for operation in self.timeline.get_operations()],
+            [(DOMAIN, 'delete', 'complete', 3.25),
+             (DISK, 'create', 'complete', 42.25),
+             (DOMAIN, 'create', 'errored', 20.0)])
+        self.assertEqual(self.timeline.get_operations()[1]['start'], '2024-01-01T12:00:02.500000+01:00')
+        self.assertEqual(self.timeline.get_operations()[1]['end'], '2024-01-01T12:00:44.750000+01:00')
+
+    def test_unfinished_and_elapsed_seconds(self):
+        new_timeline = timeline.Timeline()
+        new_timeline.feed(json.dumps({'@message': 'a: Creating...', '@timestamp': '2024-01-01T12:00:00Z',
+                                      'type': 'apply_start',
+                                      'hook': {'resource': {'addr': 'a'}, 'action': 'create'}}))
+        new_timeline.feed(json.dumps({'@message': 'b: Creation complete after 7s', '@timestamp': 'invalid',
+                                      'type': 'apply_complete',
+                                      'hook': {'resource': {'addr': 'b'}, 'action': 'create', 'elapsed_seconds': 7}}))
+        self.assertListEqual([(operation['address'], operation['status'], operation['seconds'])
+                              for operation in new_timeline.get_operations()],
+                             [('a', 'running', None), ('b', 'complete', 7)])
+        self.assertListEqual([operation['address'] for operation in new_timeline.get_slowest()], ['b'])
+
+    def test_get_slowest(self):
+        self.assertListEqual([(operation['address'], operation['action']) for operation in self.timeline.get_slowest(2)],
+                             [(DISK, 'create'), (DOMAIN, 'create')])
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'sumaform.timeline.json')
+            self.timeline.save(filename)
+            with open(filename) as timeline_file:
+                self.assertListEqual(json.load(timeline_file), self.timeline.get_operations())
+
+
+if __name__ == '__main__':
+    unittest.main()
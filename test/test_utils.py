@@ -1,3 +1,6 @@
+import fcntl
+import os
+import tempfile
 import unittest
 from terracumber import utils
 
@@ -36,6 +39,34 @@ class TestUtils(unittest.TestCase):
         dict_y = { }
         self.assertDictEqual(utils.overwrite_dict(dict_x, dict_y), { })
 
+    def test_output_tail(self):
+        tail = utils.OutputTail(3)
+        tail.feed('line1\r\nline2\nli')
+        self.assertListEqual(tail.get_lines(), ['line1', 'line2', 'li'])
+        tail.feed('ne3\nline4\nline5\n')
+        self.assertListEqual(tail.get_lines(), ['line3', 'line4', 'line5'])
+        self.assertListEqual(tail.get_errors(), [])
+
+        tail = utils.OutputTail(2, 'Error|FAILED')
+        tail.feed('Error: first\nok\nFAILED second\nok\nError: third\nok\nok\n')
+        self.assertListEqual(tail.get_lines(), ['ok', 'ok'])
+        self.assertListEqual(tail.get_errors(), ['FAILED second', 'Error: third'])
+
+        tail = utils.OutputTail(0)
+        tail.feed('line1\nline2')
+        self.assertListEqual(tail.get_lines(), [])
+
+    def test_file_lock(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, '.lock')
+            with utils.FileLock(filename):
+                # Another open file description cannot take the lock meanwhile
+                with open(filename, 'a') as other:
+                    with self.assertRaises(BlockingIOError):
+                        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with open(filename, 'a') as other:
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
 
 if __name__ == '__main__':
     unittest.main()